@@ -17,17 +17,31 @@ def optimization():
     parameters.apply_defaults()
     parameters = parameters.arguments
 
+    filename = os.path.join(output_directory, 'strats')
+
     optimizer = OptimizerCLI(cerebro, MovingAveragesCrossover, sma_testcase_generator,
+                             preload_workers=args.preload_workers,
+                             results_path=filename if args.stream_results or args.checkpoint or args.eval_cache else '',
+                             results_format=args.results_format,
+                             checkpoint=args.checkpoint,
+                             eval_cache=args.eval_cache,
+                             eval_cache_size=args.eval_cache_size,
+                             keep_top=args.keep_top,
+                             top_metric=args.top_metric,
+                             halving_eta=args.halving_eta,
+                             halving_rungs=args.halving_rungs,
+                             halving_range=(args.fromdate, args.todate),
+                             prune_margin=args.prune_margin,
+                             prune_drawdown=args.prune_drawdown,
+                             prune_checkpoints=args.prune_checkpoints,
                              **parameters,
                              )
 
     optimizer.start()
 
-    filename = os.path.join(output_directory, 'strats')
-
     optimizer.save_strats(filename)
 
-    plotly_basic.plot_2d_heatmap('slow_ma_period', 'fast_ma_period', 'returns_rtot', f'{filename}.csv', filename)
+    plotly_basic.plot_2d_heatmap('slow_ma_period', 'fast_ma_period', 'returns_rtot', f'{filename}.{args.results_format}', filename)
 
 
 def main():
@@ -41,4 +55,7 @@ def main():
 
 if __name__ == '__main__':
     # 02_sample_sma_optimization.py -o -params 0 50 -d ./data/forex_2021/hour_bar/bid/EURUSD_from_20210101_to_20211231_H1_BID.csv
+
+    # data preloaded once per worker, runonce
+    # 02_sample_sma_optimization.py -o -pw -params 0 50 -d ./data/forex_2021/hour_bar/bid/EURUSD_from_20210101_to_20211231_H1_BID.csv
     main()
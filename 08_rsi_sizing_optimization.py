@@ -18,17 +18,31 @@ def optimization():
     parameters.apply_defaults()
     parameters = parameters.arguments
 
+    filename = os.path.join(output_directory, 'strats')
+
     optimizer = OptimizerCLI(cerebro, RSIPositionSizing, rsi_sizing_testcase_generator,
+                             preload_workers=args.preload_workers,
+                             results_path=filename if args.stream_results or args.checkpoint or args.eval_cache else '',
+                             results_format=args.results_format,
+                             checkpoint=args.checkpoint,
+                             eval_cache=args.eval_cache,
+                             eval_cache_size=args.eval_cache_size,
+                             keep_top=args.keep_top,
+                             top_metric=args.top_metric,
+                             halving_eta=args.halving_eta,
+                             halving_rungs=args.halving_rungs,
+                             halving_range=(args.fromdate, args.todate),
+                             prune_margin=args.prune_margin,
+                             prune_drawdown=args.prune_drawdown,
+                             prune_checkpoints=args.prune_checkpoints,
                              **parameters,
                              )
 
     optimizer.start()
 
-    filename = os.path.join(output_directory, 'strats')
-
     optimizer.save_strats(filename)
 
-    plotly_basic.plot_2d_heatmap('period', 'size_multiplier', 'returns_rtot', f'{filename}.csv', filename)
+    plotly_basic.plot_2d_heatmap('period', 'size_multiplier', 'returns_rtot', f'{filename}.{args.results_format}', filename)
 
 
 def main():
@@ -42,4 +56,7 @@ def main():
 
 if __name__ == '__main__':
     # 08_rsi_sizing_optimization.py -o -params 0 20 0.0 0.5 0.05 30.0 40.0 60.0 70.0 5.0 -d ./data/forex_2021/hour_bar/bid/EURUSD_from_20210101_to_20211231_H1_BID.csv
+
+    # checkpointed, the same command resumes an interrupted run
+    # 08_rsi_sizing_optimization.py -o -cp ./reports/08_rsi_sizing_optimization.checkpoint.jsonl -params 0 20 0.0 0.5 0.05 30.0 40.0 60.0 70.0 5.0 -d ./data/forex_2021/hour_bar/bid/EURUSD_from_20210101_to_20211231_H1_BID.csv
     main()
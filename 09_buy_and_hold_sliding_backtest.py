@@ -18,14 +18,22 @@ def optimization():
     parameters.apply_defaults()
     parameters = parameters.arguments
 
+    filename = os.path.join(output_directory, 'strats')
+
     optimizer = OptimizerCLI(cerebro, BuyAndHold, slides_generator,
+                             preload_workers=True,  # windows skip the bars before them with runonce
+                             results_path=filename if args.stream_results or args.checkpoint or args.eval_cache else '',
+                             results_format=args.results_format,
+                             checkpoint=args.checkpoint,
+                             eval_cache=args.eval_cache,
+                             eval_cache_size=args.eval_cache_size,
+                             keep_top=args.keep_top,
+                             top_metric=args.top_metric,
                              **parameters,
                              )
 
     optimizer.start()
 
-    filename = os.path.join(output_directory, 'strats')
-
     optimizer.save_strats(filename)
 
 
@@ -5,7 +5,8 @@ from pathlib import Path
 from utils.analyzers import MultiSymbolsTradeAnalyzer, MultiSymbolsTransactions
 from utils.commissions import ForexCommission
 from utils.constants import PERIODS, SYMBOLS
-from utils.datafeeds import DownloadedCSVData, PSQLData
+from utils.caches import CandleCache
+from utils.datafeeds import ColumnarData, DownloadedCSVData, fetch_psql_columns
 from utils.strategies import CurrencyStrength
 import argparse
 import backtrader as bt
@@ -21,6 +22,10 @@ def parse_args():
                         default='', required=False,
                         help='data directory for all csv files', metavar='FILE')
 
+    parser.add_argument('--cache', dest='cache',
+                        default='', required=False,
+                        help='directory of local candle cache for PostgreSQL data', metavar='DIR')
+
     parser.add_argument('--period', '-p', choices=PERIODS.keys(),
                         default='D1', required=False,
                         help='timeframe period to be traded.')
@@ -36,21 +41,25 @@ def parse_args():
     return parser.parse_args()
 
 
-def get_datas_from_psql(period, fromdate, todate):
+def get_datas_from_psql(period, fromdate, todate, cache=''):
     datas = {}
     _, timeframe, compression, = PERIODS[period]
 
+    # one query for all symbols and price types
+    if cache:
+        columns = CandleCache(cache, fetch_psql_columns).get_columns(SYMBOLS, ('BID', 'ASK'), period, fromdate, todate)
+    else:
+        columns = fetch_psql_columns(SYMBOLS, ('BID', 'ASK'), period, fromdate, todate)
+
     for price_type in ('BID', 'ASK'):
         for symbol in SYMBOLS:
             data_name = f'{symbol}_{price_type}'
 
-            data = PSQLData(symbol=symbol,
-                            price_type=price_type,
-                            period=period,
-                            timeframe=timeframe,
-                            compression=compression,
-                            fromdate=fromdate,
-                            todate=todate)
+            data = ColumnarData(columns=columns[symbol, price_type],
+                                timeframe=timeframe,
+                                compression=compression,
+                                fromdate=fromdate,
+                                todate=todate)
 
             if price_type == 'ASK':
                 data.compensate(datas[f'{symbol}_BID'])
@@ -97,7 +106,7 @@ def collect_data_from_folder(data_directory, fromdate, todate):
     return datas
 
 
-def backtest(data_directory, period, fromdate, todate):
+def backtest(data_directory, period, fromdate, todate, cache=''):
     # create a cerebro entity
     cerebro = bt.Cerebro(stdstats=False)
 
@@ -144,7 +153,7 @@ def backtest(data_directory, period, fromdate, todate):
         data_directory = os.path.join(modpath, data_directory)
         datas = collect_data_from_folder(data_directory, fromdate, todate)
     else:
-        datas = get_datas_from_psql(period, fromdate, todate)
+        datas = get_datas_from_psql(period, fromdate, todate, cache)
 
     for name, data in datas.items():
         cerebro.adddata(data, name=name)
@@ -153,7 +162,7 @@ def backtest(data_directory, period, fromdate, todate):
     print(f'Starting Portfolio Value: {cerebro.broker.getvalue():.2f}')
 
     # Run over everything
-    runstrats = cerebro.run(runonce=False, stdstats=False)
+    runstrats = cerebro.run(runonce=True, stdstats=False)
 
     figs = cerebro.plot(BacktraderPlotly(show=True, scheme=PlotScheme()))
     figs = [x for fig in figs for x in fig]  # flatten output
@@ -169,7 +178,7 @@ def backtest(data_directory, period, fromdate, todate):
 
 def main():
     args = parse_args()
-    backtest(args.data_directory, args.period, args.fromdate, args.todate)
+    backtest(args.data_directory, args.period, args.fromdate, args.todate, args.cache)
 
 
 if __name__ == '__main__':
@@ -4,10 +4,12 @@ from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
 from sklearn.preprocessing import MinMaxScaler
 from tensorflow import keras
 from tensorflow.keras import layers
+from utils.caches import PredictionStore, file_digest
+from utils.datasets import count_windows, windowed_arrays, windowed_dataset
+from utils.predictions import predict, predict_series
 import backtest_basic
 import joblib
 import math
-import numpy as np
 import pandas as pd
 import plotly_basic
 import sys
@@ -44,14 +46,8 @@ def main():
 
         y = scaler.transform(y)
 
-        # create test data
-        test_data = y[t:]
-        x_test, y_test = [], []
-        for i in range(n_lookback, len(test_data) - n_forecast + 1):
-            x_test.append(test_data[i - n_lookback: i])
-            y_test.append(test_data[i: i + n_forecast])
-
-        x_test, y_test = np.array(x_test), np.array(y_test)
+        # create test data windows as views of the series
+        x_test, y_test = windowed_arrays(y[t:], n_lookback, n_forecast)
         time_test = df['Datetime'][t:]
 
     else:
@@ -69,23 +65,15 @@ def main():
         n_lookback = 60
         n_forecast = 5
 
-        # create train data windows of size n_lookback
+        # create train data windows of size n_lookback, gathered batch by batch from the series
+        # the last 20% of the windows are for validation, as validation_split of model.fit
         train_data = y[:t]
-        x_train, y_train = [], []
-        for i in range(n_lookback, len(train_data) - n_forecast + 1):
-            x_train.append(train_data[i - n_lookback: i])
-            y_train.append(train_data[i: i + n_forecast])
-
-        x_train, y_train = np.array(x_train), np.array(y_train)
-
-        # create test data
-        test_data = y[t:]
-        x_test, y_test = [], []
-        for i in range(n_lookback, len(test_data) - n_forecast + 1):
-            x_test.append(test_data[i - n_lookback: i])
-            y_test.append(test_data[i: i + n_forecast])
+        split_at = int(count_windows(train_data, n_lookback, n_forecast) * (1 - 0.2))
+        train_dataset = windowed_dataset(train_data, n_lookback, n_forecast, stop=split_at, batch_size=32, shuffle=True, seed=0)
+        validation_dataset = windowed_dataset(train_data, n_lookback, n_forecast, start=split_at, batch_size=32)
 
-        x_test, y_test = np.array(x_test), np.array(y_test)
+        # create test data windows as views of the series
+        x_test, y_test = windowed_arrays(y[t:], n_lookback, n_forecast)
         time_test = df['Datetime'][t:]
 
         # define model training logger
@@ -102,17 +90,22 @@ def main():
         # train and save LSTM model
         optimizer = keras.optimizers.Adam(learning_rate=0.005)
         model.compile(optimizer=optimizer, loss='mean_squared_error', metrics=['mean_absolute_error', 'mean_squared_error'])
-        model.fit(x_train, y_train, batch_size=32, epochs=128, validation_split=0.2, callbacks=[csv_logger])
+        model.fit(train_dataset, epochs=128, validation_data=validation_dataset, callbacks=[csv_logger])
 
         model.save(f'{output_path}_trained_lstm_model.h5', save_format='h5')  # save model
         joblib.dump(scaler, f'{output_path}_scaler.bin', compress=True)
 
-    # predict future prices
-    x_test = [x.reshape(1, n_lookback, 1) for x in x_test]
-    y_predicted = [scaler.inverse_transform(model.predict(x).reshape(-1, 1)) for x in x_test]
-    y_test = [scaler.inverse_transform(y.reshape(-1, 1)) for y in y_test]
+    # predict future prices, predictions of a saved model stored by an earlier run are reused
+    if args.model and args.scaler and args.prediction_cache:
+        key = dict(model=file_digest(args.model), scaler=file_digest(args.scaler), n_forecast=n_forecast)
+        close = df['Close'].fillna(method='ffill').values[t:]
+        y_predicted = predict_series(model, scaler, close, batch_size=args.batch_size,
+                                     store=PredictionStore(args.prediction_cache), key=key)[:len(x_test)]
+    else:
+        y_predicted = predict(model, x_test, scaler, batch_size=args.batch_size)
+    y_test = scaler.inverse_transform(y_test.reshape(-1, 1)).reshape(y_predicted.shape)
 
-    y_test, y_predicted = np.array(y_test).squeeze(), np.array(y_predicted).astype(np.float64).squeeze()
+    y_test, y_predicted = y_test.squeeze(), y_predicted.squeeze()
 
     # calculate metrics
     print(f'r2_score = {r2_score(y_test, y_predicted)}')
@@ -174,4 +167,6 @@ if __name__ == '__main__':
 
     # 16_lstm_price_prediction_model.py -from 2011-01-01 -to 2021-01-01 -d ./data/forex_2011_2020/day_bar/bid/EURUSD_from_20110101_to_20201231_D1_BID.csv
 
+    # 16_lstm_price_prediction_model.py -m ./models/hour_bar_predict_1_bar_training_lr_0.005_trained_lstm_model.h5 -sc ./models/hour_bar_predict_1_bar_training_lr_0.005_scaler.bin -pc ./predictions -d ./data/forex_2021/hour_bar/bid/EURUSD_from_20210101_to_20211231_H1_BID.csv
+
     main()
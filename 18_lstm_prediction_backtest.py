@@ -8,14 +8,19 @@ def main():
 
     cerebro, output_directory = backtest_basic.get_default_cerebro(**vars(args))
 
-    cerebro.addstrategy(ForecastTrading, print_log=True)
+    if args.model:
+        # forecast on the fly instead of reading a prediction column
+        cerebro.addstrategy(ForecastTrading, print_log=True, model=args.model, scaler=args.scaler, batch_size=args.batch_size)
+    else:
+        cerebro.addstrategy(ForecastTrading, print_log=True)
 
     start_cash = cerebro.broker.getvalue()
 
     print(f'Starting Portfolio Value: {start_cash:.2f}')
     # Starting Portfolio Value: 200000.00
 
-    cerebro.run(runonce=False, stdstats=False)
+    # with a model, runonce predicts all bars in batches
+    cerebro.run(runonce=bool(args.model), stdstats=False)
 
     print(f'Net   Portfolio Value: {cerebro.broker.getvalue() - start_cash:.2f}')
 
@@ -30,4 +35,6 @@ if __name__ == '__main__':
     # 18_lstm_prediction_backtest.py -pred 6 -d ./reports/add_prediction/20220423_191814_report_from_20210101_000000_to_20220101_000000_600_10_prediction.csv
     # pnl: 4865.00
 
+    # 18_lstm_prediction_backtest.py -m ./models/hour_bar_predict_1_bar_training_lr_0.005_trained_lstm_model.h5 -sc ./models/hour_bar_predict_1_bar_training_lr_0.005_scaler.bin -d ./data/forex_2021/hour_bar/bid/EURUSD_from_20210101_to_20211231_H1_BID.csv
+
     main()
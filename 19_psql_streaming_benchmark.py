@@ -0,0 +1,74 @@
+from utils.constants import PERIODS
+from utils.datafeeds import PSQLData
+import backtest_basic
+import backtrader as bt
+import multiprocessing
+import resource
+import time
+
+
+class FirstBarTimer(bt.Strategy):
+    params = (
+        ('started_at', 0.0),
+    )
+
+    def __init__(self):
+        self.time_to_first_bar = None
+        self.bars = 0
+
+    def next(self):
+        if self.time_to_first_bar is None:
+            self.time_to_first_bar = time.perf_counter() - self.p.started_at
+
+        self.bars += 1
+
+
+def run_mode(symbol, period, fromdate, todate, stream, itersize, preload):
+    _, timeframe, compression, = PERIODS[period]
+
+    cerebro = bt.Cerebro(stdstats=False, preload=preload)
+    cerebro.adddata(PSQLData(symbol=symbol,
+                             period=period,
+                             timeframe=timeframe,
+                             compression=compression,
+                             fromdate=fromdate,
+                             todate=todate,
+                             stream=stream,
+                             itersize=itersize))
+
+    started_at = time.perf_counter()
+    cerebro.addstrategy(FirstBarTimer, started_at=started_at)
+    strat, = cerebro.run(runonce=False)
+    total_time = time.perf_counter() - started_at
+
+    # ru_maxrss is reported in kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return strat.bars, strat.time_to_first_bar, total_time, peak_rss
+
+
+def main():
+    args = backtest_basic.get_default_parser('PSQL Streaming Benchmark').parse_args()
+
+    modes = (
+        ('fetchall, preload', False, True),
+        ('fetchall, no preload', False, False),
+        ('stream, preload', True, True),
+        ('stream, no preload', True, False),
+    )
+
+    # each mode runs in a fresh process so that peak rss is not shared between modes
+    ctx = multiprocessing.get_context('spawn')
+
+    print(f'{"mode":<24}{"bars":>10}{"first bar (s)":>16}{"total (s)":>12}{"peak rss (MB)":>16}')
+    for name, stream, preload in modes:
+        with ctx.Pool(1) as pool:
+            bars, time_to_first_bar, total_time, peak_rss = pool.apply(run_mode, (args.symbol, args.period, args.fromdate, args.todate,
+                                                                                  stream, args.itersize, preload))
+
+        print(f'{name:<24}{bars:>10}{time_to_first_bar:>16.3f}{total_time:>12.3f}{peak_rss:>16.1f}')
+
+
+if __name__ == '__main__':
+    # 19_psql_streaming_benchmark.py -s EURUSD -p M1 -from 2011-01-01 -to 2022-01-01 --itersize 5000
+    main()
@@ -0,0 +1,49 @@
+from pathlib import Path
+from utils.caches import save_columns
+from utils.datafeeds import DownloadedCSVData, NumpyData, csv_to_columns
+import backtest_basic
+import backtrader as bt
+import tempfile
+import time
+
+
+def preload(data):
+    bt.Cerebro().adddata(data)
+
+    started_at = time.perf_counter()
+    data._start()
+    data.preload()
+    elapsed = time.perf_counter() - started_at
+
+    data.stop()
+    return elapsed, data.buflen()
+
+
+def main():
+    parser = backtest_basic.get_default_parser('NumPy Feed Benchmark')
+    parser.add_argument('--dtformat', default='%Y-%m-%d %H:%M:%S', required=False,
+                        help='datetime format of the csv file')
+    args = parser.parse_args()
+
+    repeats = 5
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        directory = Path(temporary_directory) / 'columns'
+
+        started_at = time.perf_counter()
+        save_columns(directory, csv_to_columns(args.dataname, dtformat=args.dtformat))
+        print(f'one-time conversion: {time.perf_counter() - started_at:.3f}s')
+
+        for name, datacls, kwargs in (('line by line csv', DownloadedCSVData, dict(dataname=args.dataname, dtformat=args.dtformat, vectorized=False)),
+                                      ('vectorized csv', DownloadedCSVData, dict(dataname=args.dataname, dtformat=args.dtformat)),
+                                      ('NumpyData', NumpyData, dict(dataname=directory))):
+            timings = [preload(datacls(**kwargs)) for _ in range(repeats)]
+            best = min(elapsed for elapsed, _ in timings)
+            bars = timings[0][1]
+
+            print(f'{name:<20}{bars:>8} bars, best of {repeats}: {best:.3f}s')
+
+
+if __name__ == '__main__':
+    # 20_npy_feed_benchmark.py --dtformat "%d/%m/%Y %H:%M" -d ./data/forex_2016_2021/hour_bar/bid/EURUSD_from_20160101_to_20211231_H1_BID.csv
+    main()
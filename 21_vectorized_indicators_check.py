@@ -0,0 +1,194 @@
+from pathlib import Path
+from utils.constants import SYMBOLS
+from utils.datafeeds import DownloadedCSVData
+from utils.indicators import EightCurrenciesIndicator, TwentyeightPairsIndicator, exponential_moving_average, relative_strength_index
+import argparse
+import backtrader as bt
+import numpy as np
+
+
+class LoopEightCurrenciesIndicator(EightCurrenciesIndicator):
+    '''
+    Original bar by bar implementation, kept as reference for the vectorized one
+    '''
+
+    def __init__(self):
+        self.total_number_of_currencies = 8
+        self.total_number_of_pairs = 28
+
+        self.rsi = {}
+        for i in range(self.total_number_of_pairs):
+            pair_name = self.datas[i]._name[0:6]
+            self.rsi[pair_name] = bt.indicators.RSI(self.datas[i].lines.close, period=self.p.period).rsi()
+
+    def next(self):
+        for line in self.lines:
+            line[0] = 0
+
+        for symbol in self.datas:
+            pair_name = symbol._name[0:6]
+            base_currency = symbol._name[0:3]
+            quot_currency = symbol._name[3:6]
+
+            getattr(self.lines, base_currency)[0] += self.rsi[pair_name] * getattr(self.p, pair_name) / (self.total_number_of_currencies - 1)
+            getattr(self.lines, quot_currency)[0] += (100 - self.rsi[pair_name]) * getattr(self.p, pair_name) / (self.total_number_of_currencies - 1)
+
+    def once(self, start, end):
+        # next only, the coupled RSI lines are not computed in once mode
+        pass
+
+
+class LoopTwentyeightPairsIndicator(TwentyeightPairsIndicator):
+    '''
+    Original bar by bar implementation, kept as reference for the vectorized one
+    '''
+
+    def __init__(self):
+        self.total_number_of_currencies = 8
+        self.total_number_of_pairs = 28
+
+        self.fast_ema = {}
+        self.slow_ema = {}
+        for i in range(self.total_number_of_pairs):
+            pair_name = self.datas[i]._name[0:6]
+            self.fast_ema[pair_name] = bt.indicators.EMA(self.datas[i].lines.close, period=self.p.fast_ma_period).ema()
+            self.slow_ema[pair_name] = bt.indicators.EMA(self.datas[i].lines.close, period=self.p.slow_ma_period).ema()
+
+    def next(self):
+        for line in self.lines:
+            line[0] = 0
+
+        for symbol in self.datas:
+            pair_name = symbol._name[0:6]
+            base_currency = symbol._name[0:3]
+            quot_currency = symbol._name[3:6]
+            if(self.slow_ema[pair_name][0] != 0):
+                ma_percentage = (self.fast_ema[pair_name][0] - self.slow_ema[pair_name][0]) / self.slow_ema[pair_name][0] * getattr(self.p, pair_name)
+            else:
+                ma_percentage = 0
+
+            getattr(self.lines, base_currency)[0] += ma_percentage
+            getattr(self.lines, quot_currency)[0] -= ma_percentage
+
+        for symbol in self.datas:
+            pair_name = symbol._name[0:6]
+            base_currency = symbol._name[0:3]
+            quot_currency = symbol._name[3:6]
+            getattr(self.lines, pair_name)[0] = getattr(self.lines, base_currency)[0] - getattr(self.lines, quot_currency)[0]
+
+    def once(self, start, end):
+        # next only, the coupled EMA lines are not computed in once mode
+        pass
+
+
+class IndicatorsRecorder(bt.Strategy):
+    params = (
+        ('indicators', ()),
+        ('per_data', False),
+    )
+
+    def __init__(self):
+        if self.p.per_data:
+            self.indicators = [indcls(data, **kwargs) for indcls, kwargs in self.p.indicators for data in self.datas]
+        else:
+            self.indicators = [indcls(*self.datas, **kwargs) for indcls, kwargs in self.p.indicators]
+
+
+def get_datas(data_directory):
+    datas = []
+    for symbol in SYMBOLS:
+        file_path, = Path(data_directory).glob(f'{symbol}_*.csv')
+        datas.append(DownloadedCSVData(dataname=file_path, name=symbol))
+
+    return datas
+
+
+def run(data_directory, indicators, runonce, preload=True):
+    cerebro = bt.Cerebro(stdstats=False, preload=preload)
+    for data in get_datas(data_directory):
+        cerebro.adddata(data, name=data.p.name)
+
+    cerebro.addstrategy(IndicatorsRecorder, indicators=indicators)
+    strat, = cerebro.run(runonce=runonce)
+
+    return [np.array([line.array for line in indicator.lines]) for indicator in strat.indicators]
+
+
+def check(name, reference, other):
+    if reference.shape != other.shape:
+        print(f'{name:<48}shape {other.shape} != {reference.shape}')
+        return False
+
+    same_nan = np.array_equal(np.isnan(reference), np.isnan(other))
+    error = np.nanmax(np.abs(reference - other)) if not np.isnan(reference).all() else 0.0
+    ok = same_nan and error <= 1e-9
+
+    print(f'{name:<48}{"ok" if ok else "MISMATCH":<10}bars {reference.shape[1]:>8}  max abs diff {error:.3e}')
+    return ok
+
+
+def check_arrays(data_directory):
+    # cached arrays must be identical to the backtrader indicators they replace
+    cases = (
+        ('relative_strength_index', relative_strength_index, bt.ind.RSI, 14),
+        ('exponential_moving_average', exponential_moving_average, bt.ind.EMA, 20),
+    )
+
+    ok = True
+    for name, function, indcls, period in cases:
+        indicators = ((indcls, dict(period=period)),)
+
+        cerebro = bt.Cerebro(stdstats=False)
+        for data in get_datas(data_directory):
+            cerebro.adddata(data, name=data.p.name)
+        cerebro.addstrategy(IndicatorsRecorder, indicators=indicators, per_data=True)
+        strat, = cerebro.run(runonce=True)
+
+        # datas may differ in length, all of them are checked as one row
+        reference = np.concatenate([indicator.array for indicator in strat.indicators])[None]
+        values = np.concatenate([function(np.array(data.close.array), period) for data in strat.datas])[None]
+
+        ok = check(f'{name} exact', reference, values) and np.array_equal(reference, values, equal_nan=True) and ok
+
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check vectorized indicators against their bar by bar implementation')
+
+    parser.add_argument('--datadirectory', '-dd', dest='data_directory',
+                        default='./data/forex_2021/day_bar/bid', required=False,
+                        help='directory with csv files of all 28 symbols', metavar='DIR')
+
+    args = parser.parse_args()
+
+    # non default weights, so that a mismatch between pairs and weights would show up
+    weights = {symbol: round(0.05 + 0.9 * i / len(SYMBOLS), 3) for i, symbol in enumerate(SYMBOLS)}
+
+    cases = (
+        ('EightCurrenciesIndicator', LoopEightCurrenciesIndicator, EightCurrenciesIndicator, dict(period=14, **weights)),
+        ('TwentyeightPairsIndicator', LoopTwentyeightPairsIndicator, TwentyeightPairsIndicator, dict(fast_ma_period=3, slow_ma_period=20, **weights)),
+    )
+
+    ok = check_arrays(args.data_directory)
+
+    for name, refcls, indcls, kwargs in cases:
+        indicators = ((refcls, kwargs), (indcls, kwargs))
+
+        reference, next_values = run(args.data_directory, indicators, runonce=False)
+        _, once_values = run(args.data_directory, indicators, runonce=True)
+
+        # without preload the indicators fall back to backtrader sub-indicators
+        _, unloaded_values = run(args.data_directory, indicators, runonce=False, preload=False)
+
+        ok = check(f'{name} next', reference, next_values) and ok
+        ok = check(f'{name} once', reference, once_values) and ok
+        ok = check(f'{name} next without preload', reference, unloaded_values) and ok
+
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    # 21_vectorized_indicators_check.py -dd ./data/forex_2021/day_bar/bid
+    main()
@@ -0,0 +1,84 @@
+from numbers import Number
+from utils.optimizations import Optimizer, flatten_dict, init_preloaded_worker, run_preloaded_task
+from utils.strategies import MovingAveragesCrossover
+import backtest_basic
+import numbers
+import pandas as pd
+import time
+
+
+def legacy_build_strats_df(strats):
+    # previous implementation, one df.loc append per strategy
+    cols = tuple(strats[0].p._getkeys())
+    for name_of_analyzer, analyzer in zip(strats[0].analyzers._names, strats[0].analyzers._items):
+        if name_of_analyzer in ('tradeanalyzer', 'transactions'):
+            continue
+
+        else:
+            rets_dict = analyzer.get_analysis()
+            rets_dict = flatten_dict(rets_dict)
+            for name_of_ret in rets_dict.keys():
+                cols += (f'{name_of_analyzer}_{name_of_ret}',)
+
+    df = pd.DataFrame(columns=cols)
+
+    for strat in strats:
+        row = [value if isinstance(value, numbers.Number) else str(value) for value in strat.p._getvalues()]
+        for name_of_analyzer, analyzer in zip(strat.analyzers._names, strat.analyzers._items):
+            if name_of_analyzer in ('tradeanalyzer', 'transactions'):
+                continue
+
+            else:
+                rets_dict = analyzer.get_analysis()
+                rets_dict = flatten_dict(rets_dict)
+                for ret in rets_dict.values():
+                    row += [ret if isinstance(ret, Number) else str(ret)]
+
+        df.loc[len(df)] = row
+
+    return df
+
+
+def build_strats_df(strats):
+    optimizer = Optimizer()
+    optimizer.strats = strats
+    return optimizer.build_strats_df()
+
+
+def main():
+    parser = backtest_basic.get_default_parser('Results Table Benchmark')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000], required=False,
+                        help='numbers of strategies to assemble')
+    parser.add_argument('--legacymax', dest='legacy_max', type=int, default=10000, required=False,
+                        help='largest size also assembled by the previous implementation, it is quadratic')
+    args = parser.parse_args()
+
+    cerebro, _ = backtest_basic.get_default_cerebro(**vars(args))
+    init_preloaded_worker(cerebro)
+
+    # a single real OptReturn, repeated, has the same per strategy cost as distinct ones
+    strat, = run_preloaded_task((MovingAveragesCrossover, dict(fast_ma_period=10, slow_ma_period=30)))
+
+    print(f'{"strategies":>12}{"df.loc (s)":>14}{"column-wise (s)":>18}')
+    for size in args.sizes:
+        strats = [strat] * size
+
+        started_at = time.perf_counter()
+        df = build_strats_df(strats)
+        elapsed = time.perf_counter() - started_at
+
+        legacy = '-'
+        if size <= args.legacy_max:
+            started_at = time.perf_counter()
+            legacy_df = legacy_build_strats_df(strats)
+            legacy = f'{time.perf_counter() - started_at:.3f}'
+
+            # same table as before, as written to csv
+            assert legacy_df.to_csv() == df.to_csv()
+
+        print(f'{size:>12}{legacy:>14}{elapsed:>18.3f}')
+
+
+if __name__ == '__main__':
+    # 22_results_table_benchmark.py -d ./data/forex_2021/hour_bar/bid/EURUSD_from_20210101_to_20211231_H1_BID.csv
+    main()
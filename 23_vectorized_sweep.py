@@ -0,0 +1,66 @@
+from utils.results import write_results
+from utils.strategies import MovingAveragesCrossover, RSIPositionSizing
+from utils.testcases import rsi_testcase_generator, sma_strength_testcase_generator, sma_testcase_generator
+from utils.vectorized import VectorizedBacktest
+import backtest_basic
+import inspect
+import os
+import pandas as pd
+import random
+import time
+
+SWEEPS = {
+    'sma': (MovingAveragesCrossover, sma_testcase_generator),
+    'sma_strength': (MovingAveragesCrossover, sma_strength_testcase_generator),
+    'rsi': (RSIPositionSizing, rsi_testcase_generator),
+}
+
+
+def main():
+    parser = backtest_basic.get_default_parser('Vectorized Sweep')
+    parser.add_argument('--sweep', choices=SWEEPS.keys(), default='sma', required=False,
+                        help='strategy and test case generator of the sweep')
+    parser.add_argument('--validate', type=int, default=5, required=False,
+                        help='number of best and of random test cases run again with backtrader and compared')
+    args = parser.parse_args()
+
+    cerebro, output_directory = backtest_basic.get_default_cerebro(**dict(vars(args), optimization=True))
+    strategy, generator = SWEEPS[args.sweep]
+
+    # process command line arguments into a list of parameters
+    parameters = inspect.signature(generator).bind(*args.parameters)
+    parameters.apply_defaults()
+    testcases = list(generator(**parameters.arguments))
+
+    started_at = time.perf_counter()
+    engine = VectorizedBacktest.from_cerebro(cerebro)
+    print(f'preload: {time.perf_counter() - started_at:.3f}s')
+
+    started_at = time.perf_counter()
+    df = pd.DataFrame([engine.run(strategy, **testcase) for testcase in testcases])
+    elapsed = time.perf_counter() - started_at
+    print(f'{len(testcases)} test cases: {elapsed:.3f}s, {elapsed / max(len(testcases), 1) * 1000:.2f}ms each')
+
+    filename = os.path.join(output_directory, 'strats')
+    write_results(df, filename, args.results_format)
+
+    # the best test cases are the ones a backtrader run would be spent on, random ones cover the rest
+    best = df['returns_rtot'].nlargest(args.validate).index.tolist()
+    others = random.sample(sorted(set(df.index) - set(best)), min(args.validate, len(df) - len(best)))
+
+    started_at = time.perf_counter()
+    mismatches = 0
+    for i in best + others:
+        for key, vectorized, expected in engine.validate(strategy, **testcases[i]):
+            print(f'{str(testcases[i]):<80}{key:<28}{vectorized!s:>24}{expected!s:>24}')
+            mismatches += 1
+
+    print(f'{len(best) + len(others)} test cases validated with backtrader: {time.perf_counter() - started_at:.3f}s, {mismatches} mismatches')
+
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    # 23_vectorized_sweep.py --sweep sma -params 0 50 -d ./data/forex_2021/hour_bar/bid/EURUSD_from_20210101_to_20211231_H1_BID.csv
+    main()
@@ -0,0 +1,49 @@
+from tensorflow import keras
+from utils.predictions import lookback_windows, predict
+import backtest_basic
+import joblib
+import numpy as np
+import pandas as pd
+import time
+
+
+def main():
+    parser = backtest_basic.get_default_parser('Batched Prediction Benchmark')
+    parser.add_argument('--loopwindows', dest='loop_windows',
+                        type=int, default=0, required=False,
+                        help='number of windows predicted one by one, all if 0')
+    args = parser.parse_args()
+
+    y = pd.read_csv(args.dataname)['Close'].fillna(method='ffill').values.reshape(-1, 1)
+
+    model = keras.models.load_model(args.model)
+    _, n_lookback, _ = model.input_shape
+    _, n_forecast = model.output_shape
+
+    scaler = joblib.load(args.scaler)
+    y = scaler.transform(y)
+
+    windows = lookback_windows(y, n_lookback, n_windows=len(y) - n_forecast + 2 - n_lookback)
+    loop_windows = windows[:args.loop_windows] if args.loop_windows else windows
+
+    # one predict call per bar, as add_prediction.py used to do
+    started_at = time.perf_counter()
+    Y = [scaler.inverse_transform(model.predict(x.reshape(1, n_lookback, 1)).reshape(-1, 1)) for x in loop_windows]
+    elapsed = time.perf_counter() - started_at
+
+    expected = np.array(Y).astype(np.float64).reshape(len(loop_windows), n_forecast)
+    print(f'{"one by one":<20}{len(loop_windows):>8} windows: {elapsed:.3f}s, {elapsed / len(loop_windows) * 1000:.3f}ms each')
+
+    for batch_size in sorted({32, 256, args.batch_size}):
+        started_at = time.perf_counter()
+        y_predicted = predict(model, windows, scaler, batch_size=batch_size)
+        elapsed = time.perf_counter() - started_at
+
+        difference = np.abs(y_predicted[:len(loop_windows)] - expected).max()
+        print(f'{f"batch of {batch_size}":<20}{len(windows):>8} windows: {elapsed:.3f}s, {elapsed / len(windows) * 1000:.3f}ms each, '
+              f'max difference {difference:.3e}')
+
+
+if __name__ == '__main__':
+    # 24_batched_prediction_benchmark.py -m ./models/hour_bar_predict_1_bar_training_lr_0.005_trained_lstm_model.h5 -sc ./models/hour_bar_predict_1_bar_training_lr_0.005_scaler.bin -d ./data/forex_2021/hour_bar/bid/EURUSD_from_20210101_to_20211231_H1_BID.csv
+    main()
@@ -0,0 +1,167 @@
+from pathlib import Path
+from utils.predictions import NumpyModel, export_model
+import argparse
+import numpy as np
+import tempfile
+
+
+class LSTM:
+    '''
+    Stand-in for a keras LSTM layer with the config and weights read by `export_model`
+    '''
+
+    def __init__(self, name, n_inputs, units, return_sequences, rng):
+        self.name = name
+        self.units = units
+        self.return_sequences = return_sequences
+
+        # keras layout, gates input, forget, cell and output side by side
+        scale = 1.0 / np.sqrt(units)
+        self.kernel = rng.uniform(-scale, scale, (n_inputs, 4 * units)).astype(np.float32)
+        self.recurrent_kernel = rng.uniform(-scale, scale, (units, 4 * units)).astype(np.float32)
+        self.bias = rng.uniform(-scale, scale, 4 * units).astype(np.float32)
+
+    def get_config(self):
+        return dict(units=self.units, return_sequences=self.return_sequences, activation='tanh', recurrent_activation='sigmoid',
+                    use_bias=True, go_backwards=False, stateful=False, time_major=False)
+
+    def get_weights(self):
+        return [self.kernel, self.recurrent_kernel, self.bias]
+
+    def reference(self, x):
+        # one window and one gate at a time in float64, as written in the keras documentation
+        kernel, recurrent_kernel, bias = (np.asarray(values, dtype=np.float64) for values in self.get_weights())
+        units = self.units
+
+        def gate(k, x_t, h):
+            columns = slice(k * units, (k + 1) * units)
+            return x_t @ kernel[:, columns] + h @ recurrent_kernel[:, columns] + bias[columns]
+
+        outputs = []
+        for window in x:
+            h, c, sequence = np.zeros(units), np.zeros(units), []
+            for x_t in window:
+                i = sigmoid(gate(0, x_t, h))
+                f = sigmoid(gate(1, x_t, h))
+                g = np.tanh(gate(2, x_t, h))
+                o = sigmoid(gate(3, x_t, h))
+
+                c = f * c + i * g
+                h = o * np.tanh(c)
+                sequence.append(h)
+
+            outputs.append(np.array(sequence) if self.return_sequences else h)
+
+        return np.array(outputs)
+
+
+class Dense:
+    '''
+    Stand-in for a keras Dense layer with the config and weights read by `export_model`
+    '''
+
+    def __init__(self, name, n_inputs, units, rng):
+        self.name = name
+        self.kernel = rng.normal(0.0, 1.0 / np.sqrt(n_inputs), (n_inputs, units)).astype(np.float32)
+        self.bias = rng.normal(0.0, 0.1, units).astype(np.float32)
+
+    def get_config(self):
+        return dict(activation='linear', use_bias=True)
+
+    def get_weights(self):
+        return [self.kernel, self.bias]
+
+    def reference(self, x):
+        return x @ self.kernel.astype(np.float64) + self.bias.astype(np.float64)
+
+
+class Model:
+    '''
+    Stand-in for the keras Sequential model of 16_lstm_price_prediction_model.py, with random weights
+    '''
+
+    def __init__(self, n_lookback, n_forecast, units, seed):
+        rng = np.random.default_rng(seed)
+
+        self.input_shape = (None, n_lookback, 1)
+        self.output_shape = (None, n_forecast)
+        self.layers = [
+            LSTM('lstm', 1, units, True, rng),
+            LSTM('lstm_1', units, units, True, rng),
+            LSTM('lstm_2', units, units, False, rng),
+            Dense('dense', units, n_forecast, rng),
+        ]
+
+    def reference(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        for layer in self.layers:
+            x = layer.reference(x)
+
+        return x
+
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check NumpyModel against a reference LSTM on fixed random weights')
+
+    parser.add_argument('--windows', '-w', dest='windows',
+                        type=int, default=300, required=False,
+                        help='number of random windows, more than a batch of NumpyModel so that batches are joined')
+
+    parser.add_argument('--lookback', '-lb', dest='n_lookback',
+                        type=int, default=60, required=False,
+                        help='bars of each window')
+
+    parser.add_argument('--forecast', '-fc', dest='n_forecast',
+                        type=int, default=3, required=False,
+                        help='bars predicted for each window')
+
+    parser.add_argument('--units', '-u', dest='units',
+                        type=int, default=16, required=False,
+                        help='units of each LSTM layer')
+
+    parser.add_argument('--seed', '-s', dest='seed',
+                        type=int, default=0, required=False,
+                        help='seed of the random weights and windows')
+
+    parser.add_argument('--tolerance', '-tol', dest='tolerance',
+                        type=float, default=1e-5, required=False,
+                        help='largest difference allowed between NumpyModel and the reference')
+
+    args = parser.parse_args()
+
+    model = Model(args.n_lookback, args.n_forecast, args.units, args.seed)
+
+    rng = np.random.default_rng(args.seed + 1)
+    x = rng.uniform(0.0, 1.0, (args.windows, args.n_lookback, 1)).astype(np.float32)
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        path = Path(temporary_directory) / 'model.npz'
+        export_model(model, path)
+        exported = NumpyModel(path)
+
+    ok = exported.input_shape == model.input_shape and exported.output_shape == model.output_shape
+    print(f'{"shapes":<24}{"ok" if ok else "MISMATCH":<10}input {exported.input_shape}  output {exported.output_shape}')
+
+    predictions = exported.predict_on_batch(x)
+    expected = model.reference(x)
+    difference = float(np.abs(predictions - expected).max()) if predictions.shape == expected.shape else float('inf')
+    same = difference <= args.tolerance
+    print(f'{"predictions":<24}{"ok" if same else "MISMATCH":<10}windows {len(x):>6}  max abs diff {difference:.3e}')
+
+    empty = exported.predict_on_batch(x[:0])
+    no_windows = empty.shape == (0, args.n_forecast)
+    print(f'{"no windows":<24}{"ok" if no_windows else "MISMATCH":<10}shape {empty.shape}')
+
+    if not (ok and same and no_windows):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    # 25_numpy_model_check.py
+
+    # 25_numpy_model_check.py -u 100 -fc 1 -s 7
+    main()
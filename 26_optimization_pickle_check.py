@@ -0,0 +1,65 @@
+from pathlib import Path
+from utils.indicators import SharedLines
+from utils.optimizations import OptimizerCLI
+from utils.strategies import MovingAveragesCrossover, RSIPositionSizing
+from utils.testcases import rsi_sizing_testcase_generator, sma_testcase_generator
+import backtest_basic
+import pickle
+import tempfile
+
+
+def check(args, strategy, generator, parameters):
+    '''
+    Optimize `strategy` by `cerebro.optstrategy`, the path of the scripts run with -o only, then save and load its strategies
+    Strategies come back from the workers pickled, and are pickled again by `save_strats`
+    '''
+    cerebro, _ = backtest_basic.get_default_cerebro(**dict(vars(args), optimization=True))
+    cerebro.p.maxcpus = args.max_cpus
+
+    optimizer = OptimizerCLI(cerebro, strategy, generator, results_format=args.results_format, **parameters)
+    optimizer.start()
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        optimizer.save_strats(str(Path(temporary_directory) / 'strats'))
+
+        strats = []
+        for file in sorted(Path(temporary_directory).glob('strats_*.pickle')):
+            with open(file, 'rb') as f:
+                strats.extend(pickle.load(f))
+
+    # strategies are kept by the TimeReturn of SharpeRatio, with the indicators they share
+    shared = sum(isinstance(indicator, SharedLines)
+                 for strat in strats for indicator in strat.analyzers.sharperatio.timereturn.strategy.getindicators())
+
+    ok = len(strats) == len(optimizer.strats) == len(optimizer.testcases) > 0
+    print(f'{strategy.__name__:<28}{"ok" if ok else "MISMATCH":<10}test cases {len(optimizer.testcases):>5}  '
+          f'strategies loaded {len(strats):>5}  shared indicators {shared:>5}')
+
+    return ok
+
+
+def main():
+    parser = backtest_basic.get_default_parser('Optimization Pickle Check')
+    parser.add_argument('--maxcpus', dest='max_cpus',
+                        type=int, default=2, required=False,
+                        help='processes of the optimization, at least 2 so that strategies are pickled by the workers')
+    args = parser.parse_args()
+
+    cases = (
+        (MovingAveragesCrossover, sma_testcase_generator, dict(n=0, max_period=4)),
+        (RSIPositionSizing, rsi_sizing_testcase_generator, dict(n=0, max_period=3, size_multiplier_to=0.1)),
+    )
+
+    ok = True
+    for strategy, generator, parameters in cases:
+        ok = check(args, strategy, generator, parameters) and ok
+
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    # 26_optimization_pickle_check.py -d ./data/forex_2021/hour_bar/bid/EURUSD_from_20210101_to_20211231_H1_BID.csv
+
+    # 26_optimization_pickle_check.py --maxcpus 1 -d ./data/forex_2021/hour_bar/bid/EURUSD_from_20210101_to_20211231_H1_BID.csv
+    main()
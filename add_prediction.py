@@ -1,7 +1,6 @@
-from tensorflow import keras
+from utils.caches import PredictionStore, file_digest
+from utils.predictions import load_predictor, predict_series
 import backtest_basic
-import joblib
-import numpy as np
 import pandas as pd
 import sys
 
@@ -13,21 +12,19 @@ def main():
     df = pd.read_csv(args.dataname)
 
     y = df['Close'].fillna(method='ffill')
-    y = y.values.reshape(-1, 1)
+    y = y.values
 
-    model = keras.models.load_model(args.model)
+    # an .npz model exported by convert_model_to_npz.py runs without TensorFlow
+    model, scaler = load_predictor(args.model, args.scaler)
     _, n_lookback, _ = model.input_shape
     _, n_forecast = model.output_shape
 
-    scaler = joblib.load(args.scaler)
-    y = scaler.transform(y)
+    # predictions stored by an earlier run of the same model on the same closes are reused
+    store = PredictionStore(args.prediction_cache) if args.prediction_cache else None
+    key = dict(model=file_digest(args.model), scaler=file_digest(args.scaler), n_forecast=n_forecast)
 
-    X = [y[i - n_lookback:i].reshape(1, n_lookback, 1) for i in range(n_lookback, len(y) - n_forecast + 2)]
-    Y = [scaler.inverse_transform(model.predict(x).reshape(-1, 1)) for x in X]
-
-    y_predicted = np.array(Y).astype(np.float64).squeeze()
-    if n_forecast > 1:
-        y_predicted = y_predicted[:, -1].squeeze()
+    n_windows = max(len(y) - n_forecast + 2 - n_lookback, 0)
+    y_predicted = predict_series(model, scaler, y, batch_size=args.batch_size, store=store, key=key)[:n_windows, -1]
 
     y_n_th_prediction = pd.Series(y_predicted)  # n_th prediction from today
     df['Prediction'] = y_n_th_prediction
@@ -43,4 +40,6 @@ if __name__ == '__main__':
 
     # add_prediction.py -m ./models/hour_bar_predict_10_bar_training_lr_0.005_trained_lstm_model.h5 -sc ./models/hour_bar_predict_10_bar_training_lr_0.005_scaler.bin -a -d ./data/forex_2021/hour_bar/bid/EURUSD_from_20210101_to_20211231_H1_BID.csv
 
+    # add_prediction.py -m ./models/hour_bar_predict_1_bar_training_lr_0.005_trained_lstm_model.npz -sc ./models/hour_bar_predict_1_bar_training_lr_0.005_scaler.bin -a -d ./data/forex_2021/hour_bar/bid/EURUSD_from_20210101_to_20211231_H1_BID.csv
+
     main()
@@ -2,7 +2,8 @@ from datetime import date, datetime
 from pathlib import Path
 from utils.commissions import ForexCommission
 from utils.constants import PERIODS, SYMBOLS
-from utils.datafeeds import DownloadedCSVData, PSQLData
+from utils.datafeeds import DownloadedCSVData, NumpyData, PSQLData
+from utils.results import RESULTS_FORMATS
 import argparse
 import backtrader as bt
 import os
@@ -24,6 +25,14 @@ def get_default_parser(description='Backtest Basic'):
     parser.add_argument('--align', '-a', action='store_true',
                         required=False, help='align future prediction to today')
 
+    parser.add_argument('--batchsize', '-bs', dest='batch_size',
+                        type=int, default=1024, required=False,
+                        help='number of lookback windows per model prediction call')
+
+    parser.add_argument('--predictioncache', '-pc', dest='prediction_cache',
+                        default='', required=False,
+                        help='directory of stored predictions, only windows not predicted before are predicted', metavar='DIR')
+
     # arguments for backtest data from local csv files
     parser.add_argument('--csv', '-c', nargs='+', default=[],
                         required=False, help='input csv files', metavar='FILE')
@@ -47,6 +56,17 @@ def get_default_parser(description='Backtest Basic'):
                         default='H1', required=False,
                         help='timeframe period to be traded.')
 
+    parser.add_argument('--cache', dest='cache',
+                        default='', required=False,
+                        help='directory of local candle cache', metavar='DIR')
+
+    parser.add_argument('--stream', action='store_true',
+                        required=False, help='stream rows from a server-side cursor')
+
+    parser.add_argument('--itersize', type=int,
+                        default=2000, required=False,
+                        help='number of rows fetched per round trip when streaming')
+
     parser.add_argument('--fromdate', '-from', type=date.fromisoformat,
                         default=date(2021, 1, 1),
                         required=False, help='date starting the trade.')
@@ -61,6 +81,56 @@ def get_default_parser(description='Backtest Basic'):
     parser.add_argument('--parameters', '-params', nargs='+', type=float, default=[],
                         required=False, help='parameters for optimization')
 
+    parser.add_argument('--preloadworkers', '-pw', dest='preload_workers', action='store_true',
+                        required=False, help='preload data once per optimization worker and run with runonce')
+
+    parser.add_argument('--streamresults', '-sr', dest='stream_results', action='store_true',
+                        required=False, help='write optimization results to disk as they arrive instead of keeping all strategies')
+
+    parser.add_argument('--checkpoint', '-cp', dest='checkpoint',
+                        default='', required=False,
+                        help='jsonl file checkpointing every finished test case, streams results, a rerun with the same file skips those already done', metavar='FILE')
+
+    parser.add_argument('--evalcache', '-ec', dest='eval_cache',
+                        default='', required=False,
+                        help='sqlite file caching test case results across runs, streams results', metavar='FILE')
+
+    parser.add_argument('--evalcachesize', dest='eval_cache_size',
+                        type=int, default=100000, required=False,
+                        help='number of test case results kept in the evaluation cache, least recently used are evicted')
+
+    parser.add_argument('--keeptop', '-top', dest='keep_top',
+                        type=int, default=0, required=False,
+                        help='number of best strategies to keep and pickle when streaming results')
+
+    parser.add_argument('--topmetric', dest='top_metric',
+                        default='returns_rtot', required=False,
+                        help='result column ranking the kept strategies, prefix with - for smaller is better')
+
+    parser.add_argument('--halving', '-hv', dest='halving_eta',
+                        type=int, default=0, required=False,
+                        help='successive halving, keep the best 1/eta of the test cases on each longer date window, off if 0', metavar='ETA')
+
+    parser.add_argument('--halvingrungs', dest='halving_rungs',
+                        type=int, default=3, required=False,
+                        help='number of date windows of successive halving, the last one from fromdate to todate')
+
+    parser.add_argument('--prunemargin', '-pm', dest='prune_margin',
+                        type=float, default=0.0, required=False,
+                        help='stop a test case whose value falls below the median of completed ones by this fraction of the cash, off if 0')
+
+    parser.add_argument('--prunedrawdown', '-pd', dest='prune_drawdown',
+                        type=float, default=0.0, required=False,
+                        help='stop a test case whose drawdown exceeds this fraction, off if 0')
+
+    parser.add_argument('--prunecheckpoints', dest='prune_checkpoints',
+                        type=int, default=10, required=False,
+                        help='number of evenly spaced bars at which test cases are compared for early stopping')
+
+    parser.add_argument('--resultsformat', '-rf', dest='results_format',
+                        choices=RESULTS_FORMATS, default='csv', required=False,
+                        help='format of the optimization results, parquet is a directory of compressed typed parts and needs pyarrow')
+
     return parser
 
 
@@ -76,7 +146,7 @@ def get_output_directory_and_path(script_name, filename, fromdate, todate):
 
 
 def get_default_cerebro(model='', scaler='', csv='', dataname='', prediction=-1, symbol='EURUSD', period='H1',
-                        fromdate=date(2021, 1, 1), todate=date(2022, 1, 1),
+                        fromdate=date(2021, 1, 1), todate=date(2022, 1, 1), cache='', stream=False, itersize=2000,
                         optimization=False, cash=200000, leverage=1, **kwargs):
 
     # create a cerebro entity
@@ -99,7 +169,11 @@ def get_default_cerebro(model='', scaler='', csv='', dataname='', prediction=-1,
     cerebro.addanalyzer(bt.analyzers.TradeAnalyzer)
     cerebro.addanalyzer(bt.analyzers.Transactions, headers=True)
 
-    if dataname:
+    if dataname and os.path.isdir(dataname):
+        # directory of memory-mapped columns written by convert_csv_to_npy.py
+        data = NumpyData(dataname=dataname)
+
+    elif dataname:
         data = DownloadedCSVData(dataname=dataname, openinterest=prediction)
 
     else:
@@ -109,7 +183,10 @@ def get_default_cerebro(model='', scaler='', csv='', dataname='', prediction=-1,
                         timeframe=timeframe,
                         compression=compression,
                         fromdate=fromdate,
-                        todate=todate)
+                        todate=todate,
+                        cache=cache,
+                        stream=stream,
+                        itersize=itersize)
 
     cerebro.adddata(data, name=symbol)
 
@@ -0,0 +1,55 @@
+from pathlib import Path
+from utils.caches import save_columns
+from utils.datafeeds import csv_to_columns
+import argparse
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert CSV price data into memory-mappable NumPy columns')
+
+    parser.add_argument('--csv', '-c', nargs='+', default=[],
+                        required=False, help='input csv files, all csv files under root if not given', metavar='FILE')
+
+    parser.add_argument('--root', '-r', dest='root',
+                        default='./data', required=False,
+                        help='root directory of the csv files', metavar='DIR')
+
+    parser.add_argument('--output', '-out', dest='output',
+                        default='./data_npy', required=False,
+                        help='output directory, the layout under root is kept', metavar='DIR')
+
+    parser.add_argument('--dtformat', dest='dtformat',
+                        default='%Y-%m-%d %H:%M:%S', required=False,
+                        help='datetime format of the csv files')
+
+    parser.add_argument('--prediction', '-pred', dest='prediction',
+                        type=int, default=-1, required=False,
+                        help='data column index for prediction')
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    root = Path(args.root)
+    files = [Path(file) for file in args.csv] or sorted(root.glob('forex_*/*/*/*.csv'))
+
+    for file in files:
+        try:
+            output = Path(args.output) / file.relative_to(root).with_suffix('')
+        except ValueError:  # file is not under root
+            output = Path(args.output) / file.stem
+
+        columns = csv_to_columns(file, dtformat=args.dtformat, openinterest=args.prediction)
+        save_columns(output, columns, source=file, rows=len(columns['datetime']))
+
+        print(f'{file} -> {output} ({len(columns["datetime"])} rows)')
+
+
+if __name__ == '__main__':
+    # convert_csv_to_npy.py
+
+    # convert_csv_to_npy.py --dtformat "%d/%m/%Y %H:%M" -c ./data/forex_2016_2021/hour_bar/bid/EURUSD_from_20160101_to_20211231_H1_BID.csv
+
+    main()
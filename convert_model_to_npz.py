@@ -0,0 +1,64 @@
+from pathlib import Path
+from tensorflow import keras
+from utils.predictions import NumpyModel, export_model
+import argparse
+import numpy as np
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export trained keras models to NumPy inference files')
+
+    parser.add_argument('--model', '-m', nargs='+', default=[],
+                        required=False, help='input trained models, all .h5 files under root if not given', metavar='FILE')
+
+    parser.add_argument('--root', '-r', dest='root',
+                        default='./models', required=False,
+                        help='root directory of the trained models', metavar='DIR')
+
+    parser.add_argument('--windows', '-w', dest='windows',
+                        type=int, default=64, required=False,
+                        help='number of random windows the exported model is checked against keras with')
+
+    parser.add_argument('--tolerance', '-tol', dest='tolerance',
+                        type=float, default=1e-5, required=False,
+                        help='largest difference allowed between the exported model and keras')
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    files = [Path(file) for file in args.model] or sorted(Path(args.root).glob('*.h5'))
+    rng = np.random.default_rng(0)
+
+    mismatches = 0
+    for file in files:
+        model = keras.models.load_model(file)
+        output = file.with_suffix('.npz')
+        export_model(model, output)
+
+        started_at = time.perf_counter()
+        exported = NumpyModel(output)
+        loaded_in = time.perf_counter() - started_at
+
+        # scaled closes are within the range of the scaler, windows of random walks in [0, 1] cover it
+        _, n_lookback, n_features = model.input_shape
+        x = np.clip(rng.uniform(0.2, 0.8, (args.windows, 1, n_features)) + rng.normal(0.0, 0.01, (args.windows, n_lookback, n_features)).cumsum(axis=1), 0.0, 1.0)
+        x = x.astype(np.float32)
+
+        difference = float(np.abs(exported.predict_on_batch(x) - model.predict_on_batch(x)).max())
+        mismatches += difference > args.tolerance
+
+        print(f'{file} -> {output}, loaded in {loaded_in * 1000:.1f}ms, max difference from keras {difference:.3e}')
+
+    if mismatches:
+        raise SystemExit(f'{mismatches} exported models differ from keras by more than {args.tolerance}')
+
+
+if __name__ == '__main__':
+    # convert_model_to_npz.py
+
+    # convert_model_to_npz.py -m ./models/hour_bar_predict_1_bar_training_lr_0.005_trained_lstm_model.h5
+    main()
@@ -2,6 +2,7 @@ from backtrader_plotly.plotter import BacktraderPlotly
 from backtrader_plotly.scheme import PlotScheme
 from jenkspy import JenksNaturalBreaks
 from plotly.subplots import make_subplots
+from utils.results import read_results
 import os
 import pandas as pd
 import plotly.express as px
@@ -49,7 +50,7 @@ def marker_maker(df, color, color_header='returns_rtot'):
 
 
 def plot_2d_heatmap(x, y, z, input, output, group_by=True, keep_zero_rtot=False, show=False):
-    df = pd.read_csv(input)
+    df = read_results(input, columns=[x, y, z, 'returns_rtot'])
 
     if not keep_zero_rtot:
         df = df.loc[df['returns_rtot'] != 0]
@@ -70,16 +71,20 @@ def plot_2d_heatmap(x, y, z, input, output, group_by=True, keep_zero_rtot=False,
 
 
 def plot_3d_heatmap_with_cluster(x, y, z, w, input, output, num_of_clusters=3, keep_zero_rtot=False, show=False):
-    df = pd.read_csv(input)
+    # a csv input is rewritten with its cluster column, the clusters of a parquet input are written next to the plot
+    df = read_results(input, columns=None if input.endswith('.csv') else [x, y, z, w, 'returns_rtot'])
     jnb = JenksNaturalBreaks(nb_class=num_of_clusters)
 
     jnb.fit(df[w].tolist())
 
     legends = jnb.inner_breaks_
-    cluster = pd.DataFrame({'cluster': jnb.labels_})
+    cluster = pd.DataFrame({'cluster': jnb.labels_}, index=df.index)
 
     df['cluster'] = cluster
-    df.to_csv(input, index=False)
+    if input.endswith('.csv'):
+        df.to_csv(input)
+    else:
+        df.to_parquet(f'{output}_cluster.parquet', index=False)
 
     df = df.sort_values('cluster')
 
@@ -143,7 +148,7 @@ def plot_sliding_comparison(price, inputs, output, keep_zero_rtot=False, show=Fa
     strategy_names = []
 
     for input in inputs:
-        df = pd.read_csv(input)
+        df = read_results(input, columns=['datetime_before', 'returns_rtot'])
 
         if not keep_zero_rtot:
             df = df.loc[df['returns_rtot'] != 0]
@@ -1,5 +1,6 @@
 from collections import defaultdict
 import backtrader as bt
+import math
 
 
 class MultiSymbolsTransactions(bt.analyzers.transactions.Transactions):
@@ -166,3 +167,16 @@ class MultiSymbolsTradeAnalyzer(bt.analyzers.tradeanalyzer.TradeAnalyzer):
                     trls_wl.max = max(m, barlen2)
                     m = trls_wl.min or bt.utils.py3.MAXINT
                     trls_wl.min = min(m, barlen2 or m)
+
+
+class Pruning(bt.Analyzer):
+    '''
+    Whether a `BasicStrategyWithLog` was stopped early, and its value at each of its prune checkpoints
+    '''
+
+    def stop(self):
+        values = self.strategy.checkpoint_values
+
+        self.rets['pruned'] = self.strategy.pruned
+        for i in range(self.strategy.p.prune_checkpoints - 1):
+            self.rets[f'value_{i}'] = values.get(i, math.nan)
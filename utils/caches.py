@@ -0,0 +1,306 @@
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+from utils.constants import PERIODS
+
+import backtrader as bt
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+import sqlite3
+import tempfile
+
+COLUMNS = ('datetime', 'open', 'high', 'low', 'close', 'volume')
+
+# digests of files by their paths, sizes and modification times
+FILE_DIGESTS = {}
+
+
+def save_columns(directory, columns, **meta):
+    '''
+    Save each column as its own `.npy` file under `directory`, extra keyword arguments go to `meta.json`
+    All files are written to a new uniquely named sibling directory, then `directory`, a symbolic link to it,
+    is replaced at once, so readers and concurrent writers never see columns of two different writes
+    '''
+    directory = Path(directory)
+    directory.parent.mkdir(parents=True, exist_ok=True)
+
+    version = Path(tempfile.mkdtemp(prefix=f'{directory.name}.', dir=directory.parent))
+    for name, column in columns.items():
+        np.save(version / f'{name}.npy', np.ascontiguousarray(column, dtype=np.float64))
+
+    with open(version / 'meta.json', 'w') as f:
+        json.dump(meta, f, default=str)
+
+    previous = os.readlink(directory) if directory.is_symlink() else None
+    if directory.is_dir() and previous is None:  # a plain directory, written before columns were versioned
+        shutil.rmtree(directory)
+
+    link = version.with_name(f'{version.name}.link')
+    os.symlink(version.name, link)
+    os.replace(link, directory)
+
+    # open memory maps of the previous version stay valid after it is removed
+    if previous is not None:
+        shutil.rmtree(directory.parent / previous, ignore_errors=True)
+
+
+def load_columns(directory, mmap_mode='r'):
+    '''
+    Load all columns saved by `save_columns`, memory-mapped by default
+    returns (columns, meta)
+    '''
+    directory = Path(directory)
+
+    columns = {path.stem: np.load(path, mmap_mode=mmap_mode) for path in sorted(directory.glob('*.npy'))}
+
+    with open(directory / 'meta.json') as f:
+        meta = json.load(f)
+
+    return columns, meta
+
+
+def slice_columns(columns, fromdate=None, todate=None):
+    '''
+    Slice columns to the bars within [fromdate, todate] by binary search on the datetime column
+    '''
+    dt = columns['datetime']
+    i = 0 if fromdate is None else np.searchsorted(dt, bt.date2num(fromdate), side='left')
+    j = len(dt) if todate is None else np.searchsorted(dt, bt.date2num(todate), side='right')
+
+    return {name: column[i:j] for name, column in columns.items()}
+
+
+class CandleCache:
+    '''
+    Local on-disk cache of candles keyed by (symbol, period, price type)
+    Candles are stored by `save_columns` under `<directory>/<period>/<price_type>/<symbol>`
+    together with the datetime range that has been queried, and only
+    the part of a requested range not yet covered is fetched
+
+    `fetch` is called as fetch(symbols, price_types, period, fromdate, todate)
+    and returns {(symbol, price_type): columns}, e.g. `utils.datafeeds.fetch_psql_columns`
+
+    Bars which started less than a bar and `settle` before a fetch may still be forming or be inserted late,
+    they are kept but not marked as covered, so the next request fetches them again and replaces them
+    '''
+    settle = timedelta(minutes=10)
+
+    def __init__(self, directory, fetch):
+        self.directory = Path(directory)
+        self.fetch = fetch
+
+    def get_columns(self, symbols, price_types, period, fromdate=datetime.min, todate=datetime.max):
+        fromdate, todate = self._as_datetime(fromdate), self._as_datetime(todate)
+
+        # never mark the future or recent bars as covered, bars which are not final yet would never be fetched again
+        now = datetime.utcnow()
+        todate = min(todate, now)
+        covered_to = max(fromdate, min(todate, now - timedelta(minutes=PERIODS[period][0]) - self.settle))
+
+        # group missing ranges so that feeds missing the same range share a single fetch
+        missing = {}
+        for symbol in symbols:
+            for price_type in price_types:
+                for missing_range in self._missing_ranges(symbol, period, price_type, fromdate, todate):
+                    missing.setdefault(missing_range, set()).add((symbol, price_type))
+
+        fetched = {}
+        for (missing_from, missing_to), keys in missing.items():
+            columns = self.fetch(sorted({symbol for symbol, _ in keys}),
+                                 sorted({price_type for _, price_type in keys}),
+                                 period, missing_from, missing_to)
+
+            for key in keys:
+                fetched.setdefault(key, []).append(columns[key])
+
+        for (symbol, price_type), parts in fetched.items():
+            self._top_up(symbol, period, price_type, fromdate, todate, covered_to, parts)
+
+        return {(symbol, price_type): slice_columns(self._load(symbol, period, price_type)[0], fromdate, todate)
+                for symbol in symbols for price_type in price_types}
+
+    def path(self, symbol, period, price_type):
+        return self.directory / period / price_type / symbol
+
+    def _load(self, symbol, period, price_type):
+        path = self.path(symbol, period, price_type)
+        if not (path / 'meta.json').exists():
+            return None, None
+
+        columns, meta = load_columns(path)
+        return columns, (datetime.fromisoformat(meta['fromdate']), datetime.fromisoformat(meta['todate']))
+
+    def _missing_ranges(self, symbol, period, price_type, fromdate, todate):
+        _, coverage = self._load(symbol, period, price_type)
+        if coverage is None:
+            return [(fromdate, todate)]
+
+        cached_from, cached_to = coverage
+        missing_ranges = []
+        if fromdate < cached_from:
+            missing_ranges.append((fromdate, cached_from))
+        if todate > cached_to:
+            missing_ranges.append((cached_to, todate))
+
+        return missing_ranges
+
+    def _top_up(self, symbol, period, price_type, fromdate, todate, covered_to, parts):
+        cached, coverage = self._load(symbol, period, price_type)
+        if cached is None:
+            columns = {name: np.concatenate([part[name] for part in parts]) for name in COLUMNS}
+            cached_from, cached_to = fromdate, covered_to
+
+        else:
+            cached_from, cached_to = coverage
+            fromnum, tonum = bt.date2num(cached_from), bt.date2num(cached_to)
+
+            # fetched ranges are inclusive at both ends, drop fetched bars which are already cached,
+            # cached bars after the coverage are replaced by the fetched ones if the range after it was fetched
+            front = [{name: part[name][part['datetime'] < fromnum] for name in COLUMNS} for part in parts]
+            tail = [{name: part[name][part['datetime'] >= tonum] for name in COLUMNS} for part in parts]
+            kept = cached['datetime'] < tonum if todate > cached_to else slice(None)
+
+            columns = {name: np.concatenate([part[name] for part in front] + [cached[name][kept]] + [part[name] for part in tail])
+                       for name in COLUMNS}
+
+        save_columns(self.path(symbol, period, price_type), columns,
+                     fromdate=min(fromdate, cached_from).isoformat(),
+                     todate=max(covered_to, cached_to).isoformat())
+
+    @staticmethod
+    def _as_datetime(d):
+        if isinstance(d, datetime):
+            return d
+        if isinstance(d, date):
+            return datetime.combine(d, time.min)
+        return d
+
+
+class EvaluationCache:
+    '''
+    Persistent cache of test case records keyed by `utils.optimizations.testcase_key`, in a SQLite file
+    At most `max_entries` records are kept, the least recently used ones are evicted first
+    '''
+
+    def __init__(self, path, max_entries=100000):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS evaluations (key TEXT PRIMARY KEY, record TEXT NOT NULL, used REAL NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS evaluations_used ON evaluations (used)')
+        self.connection.commit()
+
+        self.max_entries = max_entries
+        self.puts = 0
+
+    def get_many(self, keys):
+        '''
+        Records of the cached keys among `keys`, which are marked as used
+        '''
+        records = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 512):  # below the limit of sql variables
+            chunk = keys[i: i + 512]
+            rows = self.connection.execute(f'SELECT key, record FROM evaluations WHERE key IN ({",".join("?" * len(chunk))})', chunk)
+            records.update((key, json.loads(record)) for key, record in rows)
+
+        now = datetime.now().timestamp()
+        self.connection.executemany('UPDATE evaluations SET used = ? WHERE key = ?', [(now, key) for key in records])
+        self.connection.commit()
+
+        return records
+
+    def put(self, key, record):
+        self.connection.execute('INSERT OR REPLACE INTO evaluations (key, record, used) VALUES (?, ?, ?)',
+                                (key, json.dumps(record), datetime.now().timestamp()))
+        self.connection.commit()
+
+        self.puts += 1
+        if self.puts % 1024 == 0:
+            self.evict()
+
+    def evict(self):
+        self.connection.execute('DELETE FROM evaluations WHERE key NOT IN (SELECT key FROM evaluations ORDER BY used DESC LIMIT ?)',
+                                (self.max_entries,))
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM evaluations').fetchone()[0]
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+
+def file_digest(path):
+    '''
+    Digest of the content of a file, or of every file under a directory, kept for as long as the files are unchanged
+    '''
+    paths = sorted(p for p in Path(path).rglob('*') if p.is_file()) if os.path.isdir(path) else [Path(path)]
+    stats = tuple((str(p), p.stat().st_size, p.stat().st_mtime_ns) for p in paths)
+
+    if stats not in FILE_DIGESTS:
+        digest = hashlib.blake2b(digest_size=16)
+        for p in paths:
+            digest.update(str(p.relative_to(path) if p != Path(path) else p.name).encode())
+            with open(p, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+
+        FILE_DIGESTS[stats] = digest.hexdigest()
+
+    return FILE_DIGESTS[stats]
+
+
+class PredictionStore:
+    '''
+    Predictions of a model for the lookback windows of a close series, one `.npz` file per model and series
+    A series is identified by its first `n_lookback` closes, so a data file extended by new bars finds the predictions
+    made for the shorter file, and only the windows not within its common prefix with the stored closes are predicted
+    '''
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def path(self, key, close, n_lookback):
+        digest = hashlib.blake2b(json.dumps(dict(key, n_lookback=n_lookback), sort_keys=True, default=str).encode(), digest_size=16)
+        digest.update(np.ascontiguousarray(close[:n_lookback], dtype=np.float64).tobytes())
+        return self.directory / f'{digest.hexdigest()}.npz'
+
+    def get(self, key, close, n_lookback, predict):
+        '''
+        Predictions of all windows of `close`, window i is the bars [i, i + n_lookback), as an array of shape (windows, n_forecast)
+        `key` identifies the model, e.g. the digests of its model and scaler files and its n_forecast
+        `predict(first)` returns the predictions of the windows from `first` on, only called if some are not stored
+        '''
+        close = np.asarray(close, dtype=np.float64).reshape(-1)
+        n_windows = max(len(close) - n_lookback + 1, 0)
+        path = self.path(key, close, n_lookback)
+
+        stored_close, stored = np.empty(0), None
+        if path.exists():
+            with np.load(path) as f:
+                stored_close, stored = f['close'], f['predictions']
+
+        # windows which only contain bars of the common prefix
+        n = min(len(stored_close), len(close))
+        same = (stored_close[:n] == close[:n]) | (np.isnan(stored_close[:n]) & np.isnan(close[:n]))
+        common = int(np.argmin(same)) if not same.all() else n
+        reused = min(max(common - n_lookback + 1, 0), n_windows)
+
+        if stored is not None and reused == n_windows:
+            return stored[:n_windows]
+
+        predicted = np.asarray(predict(reused), dtype=np.float64)
+        predictions = np.concatenate((stored[:reused], predicted)) if reused else predicted
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(path.with_suffix('.tmp'), 'wb') as f:
+            np.savez(f, close=close, predictions=predictions)
+        os.replace(path.with_suffix('.tmp'), path)
+
+        return predictions
@@ -1,13 +1,242 @@
+from array import array
 from datetime import datetime
-from psycopg2 import sql
+from psycopg2 import pool, sql
+from utils.caches import CandleCache, load_columns, slice_columns
 from utils.constants import *
 
 import backtrader as bt
+import collections
+import functools
+import numpy as np
 import os
+import pandas as pd
 import psycopg2
+import threading
 
+PSQL_POOLS = {}
+PSQL_POOLS_LOCK = threading.Lock()
+
+
+class LazyConnectionPool(pool.ThreadedConnectionPool):
+    '''
+    Keep up to `maxconn` idle connections for reuse, but only open them on demand
+    '''
+
+    def __init__(self, maxconn, *args, **kwargs):
+        super(LazyConnectionPool, self).__init__(0, maxconn, *args, **kwargs)
+        self.minconn = maxconn
+
+    def reserve(self, n):
+        # at least `n` connections can be taken at the same time, e.g. by feeds holding theirs for a whole run
+        with self._lock:
+            self.maxconn = self.minconn = max(self.maxconn, n)
+
+
+def get_psql_dsn(dsn=None):
+    '''
+    DSN is taken from `dsn` if given, else from `PG_DSN`,
+    else built from `PG_HOST`, `PG_PORT`, `PG_DATABASE`, `PG_USER` and `PG_PASSWORD`
+    '''
+    if dsn:
+        return dsn
+
+    if os.environ.get('PG_DSN'):
+        return os.environ['PG_DSN']
+
+    return psycopg2.extensions.make_dsn(dbname=os.environ.get('PG_DATABASE', 'forex'),
+                                        host=os.environ.get('PG_HOST', '192.168.1.71'),
+                                        port=os.environ.get('PG_PORT', '5432'),
+                                        user=os.environ.get('PG_USER', ''),
+                                        password=os.environ.get('PG_PASSWORD', ''),
+                                        )
+
+
+def get_psql_pool(dsn=None, poolsize=None):
+    '''
+    Process-wide connection pool shared by all PSQLData feeds with the same DSN
+    Pools are keyed by pid as well, connections must not be shared with forked workers
+    '''
+    key = (os.getpid(), get_psql_dsn(dsn))
+
+    with PSQL_POOLS_LOCK:
+        if key not in PSQL_POOLS:
+            poolsize = int(poolsize or os.environ.get('PG_POOL_SIZE', 8))
+            PSQL_POOLS[key] = LazyConnectionPool(poolsize, key[1])
+
+    return PSQL_POOLS[key]
+
+
+def datetime64_to_num(values):
+    '''
+    Vectorized `bt.date2num` for naive datetime64 values, exactly equal to it element by element
+    `date2num` sums the day ordinal and the fractions of hour, minute, second and microsecond with
+    `math.fsum`, the same sum is carried out here with error-free additions to round only once
+    '''
+    us = np.asarray(values, dtype='datetime64[us]').astype(np.int64)
+
+    days, us = np.divmod(us, 86400000000)
+    seconds, us = np.divmod(us, 1000000)
+    minutes, seconds = np.divmod(seconds, 60)
+    hours, minutes = np.divmod(minutes, 60)
+
+    # 719163 is the ordinal of 1970-01-01
+    num = (days + 719163).astype(np.float64)
+    err = np.zeros_like(num)
+    for term in (hours / 24.0, minutes / 1440.0, seconds / 86400.0, us / 86400e6):
+        total = num + term
+        rounded = total - num
+        err += (num - (total - rounded)) + (term - rounded)
+        num = total
+
+    return num + err
+
+
+def fetch_psql_columns(symbols, price_types, period, fromdate=datetime.min, todate=datetime.max, dsn=None, itersize=20000):
+    '''
+    Fetch candles of all `symbols` and `price_types` with a single query and
+    demultiplex the rows into column arrays, the result is suitable for `ColumnarData`
+
+    returns {(symbol, price_type): {'datetime': array, 'open': array, ...}}
+    '''
+    query = sql.SQL('SELECT {symbol}, {price_type}, {time}, {open}, {high}, {low}, {close}, {volume} '
+                    'FROM {table} '
+                    'WHERE ({period} = %s AND '
+                    '{price_type} = ANY(%s) AND '
+                    '{symbol} = ANY(%s) AND '
+                    '{volume} > 0 AND '
+                    '{time} BETWEEN %s AND %s)'
+                    'ORDER BY {symbol}, {price_type}, {time}').format(table=sql.Identifier('candlesticks_candlestick'),
+                                                                      symbol=sql.Identifier('symbol'),
+                                                                      price_type=sql.Identifier('price_type'),
+                                                                      time=sql.Identifier('time'),
+                                                                      open=sql.Identifier('open'),
+                                                                      high=sql.Identifier('high'),
+                                                                      low=sql.Identifier('low'),
+                                                                      close=sql.Identifier('close'),
+                                                                      volume=sql.Identifier('volume'),
+                                                                      period=sql.Identifier('period'),)
+
+    period, _, _, = PERIODS[period]
+
+    # each value goes straight into a typed array of its column, 8 bytes a value instead of a python float in a list
+    names = ('datetime', 'open', 'high', 'low', 'close', 'volume')
+    arrays = collections.defaultdict(lambda: tuple(array('d') for _ in names))
+
+    conn = get_psql_pool(dsn).getconn()
+    try:
+        # named cursor fetches `itersize` rows at a time, so only one batch of rows is held as tuples
+        with conn.cursor(name='fetch_psql_columns') as cursor:
+            cursor.itersize = itersize
+            cursor.execute(query, (period, list(price_types), list(symbols), fromdate, todate))
+
+            for symbol, price_type, time, *ohlcv in cursor:
+                datetimes, *values = arrays[symbol, price_type]
+                datetimes.append(bt.date2num(time))
+                for column, value in zip(values, ohlcv):
+                    column.append(value)
+    finally:
+        get_psql_pool(dsn).putconn(conn)
+
+    columns = {}
+    for symbol in symbols:
+        for price_type in price_types:
+            columns[symbol, price_type] = {name: np.frombuffer(column, dtype=np.float64)
+                                           for name, column in zip(names, arrays.pop((symbol, price_type), arrays.default_factory()))}
+
+    return columns
+
+
+def window_indices(data, dtnum_from, dtnum_before):
+    '''
+    Indices of the first bars at or after `dtnum_from` and `dtnum_before` of a preloaded data, by binary search
+    '''
+    dt = np.frombuffer(data.datetime.array)[:data.buflen()]
+    start, end = np.searchsorted(dt, (dtnum_from, dtnum_before), side='left')
+
+    return int(start), int(end)
+
+
+class ColumnsLoader:
+    '''
+    Mixin for feeds which load their bars from column arrays
+    Must be listed after the backtrader base class, otherwise the lines of the feed are declared twice
+    '''
+    columns = None
+
+    def _start_columns(self, columns):
+        self.columns = [(getattr(self.lines, name), column) for name, column in columns.items()]
+        self.column_i = 0
+        self.column_len = len(columns['datetime'])
+
+    def _load_columns(self):
+        if self.column_i >= self.column_len:
+            return False
+
+        for line, column in self.columns:
+            line[0] = column[self.column_i]
+
+        self.column_i += 1
+        return True
+
+    def _can_preload_columns(self):
+        # bulk loading bypasses the timezone conversion and the filters applied bar by bar in `load`
+        return not (self._tzinput or self._filters or self._ffilters)
+
+    def _preload_columns(self):
+        '''
+        Copy the remaining columns into the line buffers in one go, same result as `preload`
+        Bars before fromdate are skipped and loading stops at the first bar after todate as in `load`
+        '''
+        columns = {id(line): np.asarray(column, dtype=np.float64)[self.column_i:] for line, column in self.columns}
+
+        dt = columns[id(self.lines.datetime)]
+        after = np.flatnonzero(dt > self.todate)
+        stop = after[0] if len(after) else len(dt)
+        keep = dt[:stop] >= self.fromdate
+
+        for line in self.lines:
+            if id(line) in columns:
+                values = columns[id(line)][:stop][keep]
+            else:
+                values = np.full(np.count_nonzero(keep), np.nan)
+
+            line.array.frombytes(np.ascontiguousarray(values).tobytes())
+
+        self.column_i = self.column_len
+        self.columns = None
+
+        self._last()
+        self.home()
+
+
+class ColumnarData(bt.feeds.DataBase, ColumnsLoader):
+    '''
+    Lightweight feed over column arrays which are already in memory
+    `columns` maps line names to arrays of equal length, datetime as backtrader date numbers
+    Lines without a column are left as NaN
+    '''
+    params = (
+        ('columns', None),
+    )
+
+    def start(self):
+        super(ColumnarData, self).start()
+        self._start_columns(self.p.columns)
+
+    def _load(self):
+        return self._load_columns()
+
+    def preload(self):
+        if self._can_preload_columns():
+            self._preload_columns()
+        else:
+            super(ColumnarData, self).preload()
+
+
+class PSQLData(bt.feeds.DataBase, ColumnsLoader):
+    conn = None
+    cursor = None
 
-class PSQLData(bt.feeds.DataBase):
     params = (
         ('dataname', None),
         ('name', None),
@@ -29,18 +258,64 @@ class PSQLData(bt.feeds.DataBase):
 
         # specific params
         ('price_type', 'BID'),
+
+        # connection pool, see `get_psql_dsn` for defaults
+        ('dsn', None),
+        ('poolsize', None),
+
+        # directory of the local candle cache, empty to always query
+        ('cache', ''),
+
+        # stream rows from a server-side cursor instead of fetching all rows at start
+        ('stream', False),
+        ('itersize', 2000),
     )
 
     def start(self):
+        if self.p.cache:
+            # serve from the local cache, only candles not yet cached are queried
+            cache = CandleCache(self.p.cache, functools.partial(fetch_psql_columns, dsn=self.p.dsn))
+            columns = cache.get_columns([self.p.symbol], [self.p.price_type], self.p.period, self.p.fromdate, self.p.todate)
+            self._start_columns(columns[self.p.symbol, self.p.price_type])
+            self.rows = None
+
+        elif self.p.stream:
+            # keep connection open, rows are pulled on demand in `_load`, all streaming feeds of the cerebro
+            # are started before any of them is done, so the pool must hold a connection for each of them
+            env = getattr(self, '_env', None)
+            streams = [data for data in env.datas if isinstance(data, PSQLData) and data.p.stream and
+                       get_psql_dsn(data.p.dsn) == get_psql_dsn(self.p.dsn)] if env is not None else [self]
+            get_psql_pool(self.p.dsn, self.p.poolsize).reserve(len(streams))
+
+            self.conn = self._connect_db()
+
+            # named cursor lives on the server and is fetched in batches of `itersize` rows
+            self.cursor = self.conn.cursor(name=f'psqldata_{self.p.symbol}_{self.p.price_type}_{id(self)}'.lower())
+            self.cursor.itersize = self.p.itersize
+            self._execute(self.cursor)
+            self.rows = None
+
+        else:
+            self.rows = self._fetch_rows()
+
         self.p.period, self.p.timeframe, self.p.compression, = PERIODS[self.p.period]
 
         if not self.p.name:
             self.p.name = self.p.symbol
 
-        # connect to PSQL
+        self.rows_i = 0
+        super(PSQLData, self).start()
+
+    def _fetch_rows(self):
         conn = self._connect_db()
-        cursor = conn.cursor()
+        try:
+            with conn.cursor() as cursor:
+                self._execute(cursor)
+                return cursor.fetchall()
+        finally:
+            self._release_db(conn)
 
+    def _execute(self, cursor):
         # define query
         query = sql.SQL('SELECT {time}, {open}, {high}, {low}, {close}, {volume}, {price_type} '
                         'FROM {table} '
@@ -60,21 +335,31 @@ class PSQLData(bt.feeds.DataBase):
                                                   volume=sql.Identifier('volume'),
                                                   period=sql.Identifier('period'),)
 
+        period, _, _, = PERIODS[self.p.period]
+
         # execute query template with input parameters
-        cursor.execute(query, (self.p.period, self.p.price_type, self.p.symbol, self.p.fromdate, self.p.todate))
+        cursor.execute(query, (period, self.p.price_type, self.p.symbol, self.p.fromdate, self.p.todate))
 
-        self.rows = cursor.fetchall()
+    def stop(self):
+        self._close_cursor()
+        super(PSQLData, self).stop()
 
-        conn.close()
+    def _load(self):
+        if self.columns is not None:
+            return self._load_columns()
 
-        self.rows_i = 0
-        super(PSQLData, self).start()
+        if self.cursor is not None:
+            row = next(self.cursor, None)
+            if row is None:
+                self._close_cursor()
+                return False
 
-    def _load(self):
-        if self.rows is None or self.rows_i >= len(self.rows):
+        elif self.rows is None or self.rows_i >= len(self.rows):
             return False
 
-        row = self.rows[self.rows_i]
+        else:
+            row = self.rows[self.rows_i]
+            self.rows_i += 1
 
         for datafield in self.getlinealiases():
 
@@ -91,24 +376,88 @@ class PSQLData(bt.feeds.DataBase):
                 else:
                     getattr(self.lines, datafield)[0] = row[col_idx]
 
-        self.rows_i += 1
         return True
 
     def _connect_db(self):
-        conn = psycopg2.connect(database='forex',
-                                host='192.168.1.71',
-                                port='5432',
-                                user=os.environ.get('PG_USER', ''),
-                                password=os.environ.get('PG_PASSWORD', '')
-                                )
-        return conn
+        # borrow a connection from the shared pool
+        return get_psql_pool(self.p.dsn, self.p.poolsize).getconn()
+
+    def _release_db(self, conn):
+        get_psql_pool(self.p.dsn, self.p.poolsize).putconn(conn)
+
+    def _close_cursor(self):
+        if self.cursor is not None:
+            self.cursor.close()
+            self._release_db(self.conn)
+            self.conn, self.cursor = None, None
 
     def preload(self):
-        super(PSQLData, self).preload()
+        if self.columns is not None and self._can_preload_columns():
+            self._preload_columns()
+        else:
+            super(PSQLData, self).preload()
+
+        self._close_cursor()
         self.rows = None
+        self.columns = None
+
+
+class VectorizedCSVData(bt.feeds.GenericCSVData, ColumnsLoader):
+    '''
+    GenericCSVData which preloads the whole file with `pandas.read_csv` instead of parsing it line by line
+    Datetimes are parsed in bulk with the fixed `dtformat` (and `tmformat`) and the line buffers are filled in one go
+    Falls back to the line parser for non string `dtformat`, daily or larger timeframes, input timezones and filters
+    '''
+    params = (
+        ('vectorized', True),
+    )
+
+    def preload(self):
+        if not (self.p.vectorized and self._dtstr and self.p.timeframe < bt.TimeFrame.Days and self._can_preload_columns()):
+            return super(VectorizedCSVData, self).preload()
+
+        self._start_columns(self._read_columns())
+        self._preload_columns()
+
+        # preloaded - no need to keep the object around - breaks multip in 3.x
+        self.f.close()
+        self.f = None
 
+    def _read_columns(self):
+        # headers have been skipped in `start`, the rest of the file is read from the open file object
+        fields = {name: getattr(self.p, name) for name in self.getlinealiases()}
+        fields['time'] = self.p.time
 
-class DownloadedCSVData(bt.feeds.GenericCSVData):
+        usecols = sorted({index for index in fields.values() if index is not None and index >= 0})
+        dtypes = {index: str for index in (self.p.datetime, self.p.time) if index >= 0}
+
+        try:
+            df = pd.read_csv(self.f, sep=self.separator, header=None, usecols=usecols, dtype=dtypes,
+                             keep_default_na=False, na_values=[''], float_precision='round_trip')
+        except pd.errors.EmptyDataError:
+            df = pd.DataFrame(columns=usecols)
+
+        dtfield, dtformat = df[self.p.datetime], self.p.dtformat
+        if self.p.time >= 0:
+            # add time value and format if it's in a separate field
+            dtfield, dtformat = dtfield + 'T' + df[self.p.time], dtformat + 'T' + self.p.tmformat
+
+        columns = {'datetime': datetime64_to_num(pd.to_datetime(dtfield, format=dtformat).to_numpy())}
+        for name, index in fields.items():
+            if name in ('datetime', 'time'):
+                continue
+
+            if index is None or index < 0:
+                # the field will not be present, assign the "nullvalue"
+                columns[name] = np.full(len(df), float(self.p.nullvalue))
+            else:
+                # empty fields are read as NaN, assign the "nullvalue"
+                columns[name] = df[index].astype(np.float64).fillna(float(self.p.nullvalue)).to_numpy()
+
+        return columns
+
+
+class DownloadedCSVData(VectorizedCSVData):
     # default parameters
     params = (
         ('nullvalue', 0.0),
@@ -128,7 +477,55 @@ class DownloadedCSVData(bt.feeds.GenericCSVData):
     )
 
 
-class TickDataSuiteCSVData(bt.feeds.GenericCSVData):
+class NumpyData(bt.feeds.DataBase, ColumnsLoader):
+    '''
+    Drop-in replacement for DownloadedCSVData reading memory-mapped `.npy` columns,
+    `dataname` is a directory written by `save_columns`, e.g. by convert_csv_to_npy.py
+    Processes reading the same directory share its pages through the OS cache
+    '''
+    params = (
+        ('timeframe', bt.TimeFrame.Minutes),
+        ('compression', 60),
+    )
+
+    def start(self):
+        super(NumpyData, self).start()
+
+        columns, _ = load_columns(self.p.dataname)
+
+        # skip bars outside fromdate and todate by binary search instead of loading and discarding them
+        self._start_columns(slice_columns(columns, self.p.fromdate, self.p.todate))
+
+    def _load(self):
+        return self._load_columns()
+
+    def preload(self):
+        if self._can_preload_columns():
+            self._preload_columns()
+        else:
+            super(NumpyData, self).preload()
+
+        # preloaded - drop references to the mapped files before being pickled to optimization workers
+        self.columns = None
+
+
+def csv_to_columns(dataname, datacls=DownloadedCSVData, **kwargs):
+    '''
+    Parse a csv file once with the csv feed `datacls` and return all of its lines as column arrays
+    '''
+    data = datacls(dataname=dataname, **kwargs)
+    bt.Cerebro().adddata(data)
+
+    data._start()
+    data.preload()
+
+    columns = {name: np.array(getattr(data.lines, name).array, dtype=np.float64) for name in data.getlinealiases()}
+    data.stop()
+
+    return columns
+
+
+class TickDataSuiteCSVData(VectorizedCSVData):
     # Default parameters settings
     params = (
         ('nullvalue', 0.0),
@@ -0,0 +1,58 @@
+from numpy.lib.stride_tricks import sliding_window_view
+
+import numpy as np
+
+
+def as_columns(values):
+    # series of shape (bars, columns), a single column series may be given as 1-d
+    values = np.asarray(values)
+    return values.reshape(-1, 1) if values.ndim == 1 else values
+
+
+def count_windows(values, n_lookback, n_forecast):
+    # number of bars which have `n_lookback` bars before them and `n_forecast` bars from them on
+    return max(len(values) - n_lookback - n_forecast + 1, 0)
+
+
+def windowed_arrays(values, n_lookback, n_forecast, target=0):
+    '''
+    Lookback windows of all columns of `values` and the following `n_forecast` values of the `target` column,
+    as read-only strided views of shapes (windows, n_lookback, columns) and (windows, n_forecast, 1) over `values`
+    Window i is the bars [i, i + n_lookback) and its forecast the bars [i + n_lookback, i + n_lookback + n_forecast)
+    '''
+    values = as_columns(values)
+    n_windows = count_windows(values, n_lookback, n_forecast)
+
+    x = sliding_window_view(values, n_lookback, axis=0).swapaxes(1, 2)[:n_windows]
+    y = sliding_window_view(values[n_lookback:, target], n_forecast)[:n_windows, :, np.newaxis]
+
+    return x, y
+
+
+def windowed_dataset(values, n_lookback, n_forecast, target=0, start=0, stop=None, batch_size=32, shuffle=False, seed=None):
+    '''
+    `tf.data` dataset of the batches of windows `start` to `stop` of `windowed_arrays`, for `model.fit` and `model.evaluate`
+    Only the series is held as a tensor, the windows of a batch are gathered from it when the batch is needed
+    and the next batches are prefetched while the model runs
+    '''
+    # imported here so that the windowed arrays are available without TensorFlow
+    import tensorflow as tf
+
+    values = as_columns(values)
+    n_windows = count_windows(values, n_lookback, n_forecast)
+    stop = n_windows if stop is None else min(stop, n_windows)
+
+    series = tf.constant(values, dtype=tf.float32)
+    lookback = tf.range(n_lookback, dtype=tf.int64)
+    forecast = tf.range(n_lookback, n_lookback + n_forecast, dtype=tf.int64)
+
+    def gather(i):
+        x = tf.gather(series, i[:, tf.newaxis] + lookback)
+        y = tf.gather(series[:, target:target + 1], i[:, tf.newaxis] + forecast)
+        return x, y
+
+    dataset = tf.data.Dataset.range(start, stop)
+    if shuffle:
+        dataset = dataset.shuffle(stop - start, seed=seed, reshuffle_each_iteration=True)
+
+    return dataset.batch(batch_size).map(gather, num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
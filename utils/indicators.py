@@ -1,4 +1,271 @@
+from array import array
+from utils.constants import CURRENCIES
+from utils.predictions import load_predictor, lookback_windows, predict
+
 import backtrader as bt
+import hashlib
+import math
+import numpy as np
+
+# indicator arrays over preloaded datas, shared by all indicator instances of the process
+INDICATOR_ARRAYS = {}
+
+# indicators over preloaded datas by class, parameters and inputs, or their lines once computed, see `shared_indicator`
+SHARED_INDICATORS = {}
+SHARED_CLASSES = {}
+
+# parameters which only change how an indicator is plotted, not its lines, left out of the keys of shared indicators
+PLOT_PARAMS = {
+    bt.ind.RSI: ('upperband', 'lowerband'),
+}
+
+
+def currency_incidence(pair_names):
+    '''
+    Incidence matrices of shape (8, number of pairs) of the base and the quote currency of each pair
+    '''
+    base = np.zeros((len(CURRENCIES), len(pair_names)))
+    quot = np.zeros((len(CURRENCIES), len(pair_names)))
+
+    for i, pair_name in enumerate(pair_names):
+        base[CURRENCIES.index(pair_name[0:3]), i] = 1
+        quot[CURRENCIES.index(pair_name[3:6]), i] = 1
+
+    return base, quot
+
+
+def incidence_product(incidence, values):
+    '''
+    `incidence @ values`, but NaN values of a pair only spread to the currencies the pair is incident to,
+    as when adding up pair by pair
+    '''
+    isnan = np.isnan(values)
+    product = incidence @ np.where(isnan, 0, values)
+    product[(incidence != 0) @ isnan] = np.nan
+
+    return product
+
+
+def clock_aligned(series, data, clock):
+    '''
+    Values of `series`, a line or an array which runs on the clock of `data`, at each bar of the data `clock`
+    Each bar takes the last value at or before its datetime, as seen by an indicator in `next`
+    '''
+    values = series if isinstance(series, np.ndarray) else np.frombuffer(series.array)
+    if data is clock:
+        return values
+
+    index = np.searchsorted(np.frombuffer(data.datetime.array), np.frombuffer(clock.datetime.array), side='right') - 1
+    return np.where(index >= 0, values[index], np.nan)
+
+
+def current_value(series, data):
+    # value of a line or an array which runs on the clock of `data` at the current bar
+    if isinstance(series, np.ndarray):
+        return series[len(data) - 1] if len(data) else np.nan
+
+    return series[0]
+
+
+def set_line_values(line, start, end, values):
+    # copy the bars start to end from a float64 array into the buffer of `line`
+    line.array[start:end] = array('d', np.ascontiguousarray(values[start:end], dtype=np.float64).tobytes())
+
+
+def is_preloaded(data):
+    # all bars are in the buffers before the strategies are created
+    return data.buflen() > 0 and len(data) == 0
+
+
+def preloaded_fingerprint(data):
+    '''
+    Identify a preloaded data by its name and the content of its datetime and close lines,
+    the digest is kept on the data so that it is computed once per data and process
+    '''
+    if getattr(data, '_fingerprint', (None,))[0] != data.buflen():
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(data.datetime.array)
+        digest.update(data.close.array)
+
+        data._fingerprint = (data.buflen(), digest.hexdigest())
+
+    return data._name, data._fingerprint[1]
+
+
+def cached_array(data, function, period):
+    '''
+    `function(close, period)` over the close of all bars of a preloaded data, computed once per process
+    Strategies of an optimization share the datas, so only the first instance pays for the computation
+    '''
+    key = (preloaded_fingerprint(data), function.__name__, period)
+    if key not in INDICATOR_ARRAYS:
+        INDICATOR_ARRAYS[key] = function(np.frombuffer(data.close.array).copy(), period)
+
+    return INDICATOR_ARRAYS[key]
+
+
+def exponential_smoothing(values, period, alpha, start=0):
+    '''
+    Same as `bt.ind.ExponentialSmoothing`, seeded with the mean of the first `period` values from `start`
+    Operations are carried out in the same order, so the result is identical to the indicator
+    '''
+    result = np.full(len(values), np.nan)
+    if len(values) < start + period:
+        return result
+
+    prev = math.fsum(values[start:start + period]) / period
+    smoothed = [prev]
+
+    alpha1 = 1.0 - alpha
+    for value in values[start + period:].tolist():
+        prev = prev * alpha1 + value * alpha
+        smoothed.append(prev)
+
+    result[start + period - 1:] = smoothed
+    return result
+
+
+def simple_moving_average(values, period):
+    # array version of `bt.ind.SMA`, each mean is the `math.fsum` of its window as in the indicator
+    result = np.full(len(values), np.nan)
+    if len(values) < period:
+        return result
+
+    values = values.tolist()
+    result[period - 1:] = [math.fsum(values[i - period + 1:i + 1]) for i in range(period - 1, len(values))]
+    return result / period
+
+
+def crossover(values0, values1):
+    '''
+    Same as `bt.ind.CrossOver`, 1.0 where `values0` crosses `values1` upwards, -1.0 downwards and 0.0 elsewhere
+    The last non zero difference is carried forward, so touching without crossing is not a cross
+    '''
+    diff = values0 - values1
+    result = np.full(len(diff), np.nan)
+
+    valid = np.flatnonzero(~np.isnan(diff))
+    if len(valid) < 2:
+        return result
+
+    # last non zero difference, seeded with the first difference even if it is 0
+    first = valid[0]
+    index = np.where(diff != 0, np.arange(len(diff)), first)
+    nzd = diff[np.maximum.accumulate(index[first:])]
+
+    up = (nzd[:-1] < 0.0) & (diff[first + 1:] > 0.0)
+    down = (nzd[:-1] > 0.0) & (diff[first + 1:] < 0.0)
+    result[first + 1:] = up.astype(np.float64) - down
+    return result
+
+
+def exponential_moving_average(close, period):
+    # array version of `bt.ind.EMA`
+    return exponential_smoothing(close, period, alpha=2.0 / (1.0 + period))
+
+
+def relative_strength_index(close, period, safediv=False):
+    # array version of `bt.ind.RSI` with the default smoothed moving average and lookback of 1, `safediv` makes 0 / 0 an RSI of 50.0
+    diff = np.full(len(close), np.nan)
+    diff[1:] = close[1:] - close[:-1]
+
+    maup = exponential_smoothing(np.maximum(diff, 0.0), period, alpha=1.0 / period, start=1)
+    madown = exponential_smoothing(np.maximum(-diff, 0.0), period, alpha=1.0 / period, start=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rs = maup / madown
+
+    if safediv:
+        rs[(maup == 0.0) & (madown == 0.0)] = 1.0  # the rs of an RSI of 50.0
+
+    return 100.0 - 100.0 / (1.0 + rs)
+
+
+class SharedLines(bt.Indicator):
+    '''
+    Lines copied from an indicator computed by an earlier strategy of the process, made by `shared_indicator`
+    through a subclass of `shared_class` with the lines of the indicator
+    '''
+    params = (
+        ('arrays', ()),
+        ('minperiods', ()),
+    )
+
+    source_class = None
+
+    def __reduce__(self):
+        # subclasses are made at runtime and cannot be found by name when unpickled, e.g. in the parent process
+        # of an optimization, as strategies are kept by the TimeReturn of SharpeRatio, so they are made again there
+        return new_shared_lines, (self.source_class,), self.__dict__
+
+    def __init__(self):
+        for line, minperiod in zip(self.lines, self.p.minperiods):
+            line.updateminperiod(minperiod)
+
+    def next(self):
+        for line, values in zip(self.lines, self.p.arrays):
+            line[0] = values[len(self) - 1]
+
+    def once(self, start, end):
+        for line, values in zip(self.lines, self.p.arrays):
+            set_line_values(line, start, end, values)
+
+
+def shared_class(indcls):
+    # subclass of `SharedLines` with the lines and plotinfo of `indcls`, made once per process
+    if indcls not in SHARED_CLASSES:
+        SHARED_CLASSES[indcls] = type(f'Shared{indcls.__name__}', (SharedLines,),
+                                      dict(lines=indcls.lines._getlines(), plotinfo=dict(indcls.plotinfo._getitems()),
+                                           source_class=indcls, __module__=__name__))
+
+    return SHARED_CLASSES[indcls]
+
+
+def new_shared_lines(indcls):
+    # instance of `shared_class(indcls)` without calling the metaclass, its state is set by unpickling
+    return object.__new__(shared_class(indcls))
+
+
+def shared_input_key(data):
+    if isinstance(data, bt.AbstractDataBase):
+        return ('data', preloaded_fingerprint(data)) if is_preloaded(data) else None
+
+    if isinstance(data, (int, float)):
+        return ('value', data)
+
+    return getattr(data, '_shared_key', None)
+
+
+def shared_indicator(indcls, *datas, **kwargs):
+    '''
+    `indcls(*datas, **kwargs)` over preloaded datas, its lines are computed by the first strategy of the process
+    and copied by every later strategy asking for the same indicator, e.g. the strategies of sliding windows
+    Inputs are preloaded datas, numbers or other shared indicators, anything else makes a regular indicator
+    '''
+    inputs = tuple(shared_input_key(data) for data in datas)
+    if not datas or None in inputs:
+        return indcls(*datas, **kwargs)
+
+    key = (indcls, inputs, tuple(sorted((name, value) for name, value in kwargs.items() if name not in PLOT_PARAMS.get(indcls, ()))))
+    clock = next(data for data in datas if not isinstance(data, (int, float)))
+
+    source = SHARED_INDICATORS.get(key)
+    if isinstance(source, bt.Indicator) and source.buflen() == clock.buflen():
+        # computed over all bars, only its lines are kept
+        source = SHARED_INDICATORS[key] = (tuple(np.frombuffer(line.array).copy() for line in source.lines),
+                                           tuple(line._minperiod for line in source.lines))
+
+    if isinstance(source, tuple):
+        arrays, minperiods = source
+        plotkwargs = {key: value for key, value in kwargs.items() if key in indcls.plotinfo._getkeys()}
+        indicator = shared_class(indcls)(*datas, arrays=arrays, minperiods=minperiods, **plotkwargs)
+
+    else:
+        # not computed yet, or only partially by a strategy stopped early without runonce
+        indicator = SHARED_INDICATORS[key] = indcls(*datas, **kwargs)
+
+    indicator._shared_key = key
+    return indicator
 
 
 class VolumeWeightedAveragePrice(bt.Indicator):
@@ -94,26 +361,39 @@ class EightCurrenciesIndicator(bt.Indicator):
         self.total_number_of_currencies = 8
         self.total_number_of_pairs = 28
 
-        # Two EMAs used for ACS evaluations
-        self.rsi = {}
+        # RSI of each pair used for CS evaluations
+        self.pair_names = [data._name[0:6] for data in self.datas]
+        if all(is_preloaded(data) for data in self.datas):
+            # RSI arrays are shared with all instances over the same datas, e.g. when only weights are optimized
+            self.rsi = [cached_array(data, relative_strength_index, self.p.period) for data in self.datas]
+            self.addminperiod(self.p.period + 1)
+        else:
+            self.rsi = [bt.indicators.RSI(data.lines.close, period=self.p.period).lines.rsi for data in self.datas]
+
+        # each currency adds up RSI of pairs it is base of, and (100 - RSI) of pairs it is quote of
+        self.weights = np.array([[getattr(self.p, pair_name)] for pair_name in self.pair_names])
+        self.base, self.quot = currency_incidence(self.pair_names)
 
-        for i in range(self.total_number_of_pairs):
-            pair_name = self.datas[i]._name[0:6]
-            self.rsi[pair_name] = bt.indicators.RSI(self.datas[i].lines.close, period=self.p.period).rsi()
+    def currency_strength(self, rsi):
+        # (8, 28) @ (28, T) -> (8, T)
+        return (incidence_product(self.base, rsi * self.weights / (self.total_number_of_currencies - 1)) +
+                incidence_product(self.quot, (100 - rsi) * self.weights / (self.total_number_of_currencies - 1)))
 
     def next(self):
-        # Initialize each line value for today
-        for line in self.lines:
-            line[0] = 0
+        strength = self.currency_strength(np.array([[current_value(rsi, data)] for rsi, data in zip(self.rsi, self.datas)]))
+
+        for i, line in enumerate(self.lines):
+            line[0] = strength[i, 0] if i < self.total_number_of_currencies else 0
 
-        # Calculate values for each currency line
-        for symbol in self.datas:
-            pair_name = symbol._name[0:6]
-            base_currency = symbol._name[0:3]
-            quot_currency = symbol._name[3:6]
+    def once(self, start, end):
+        # all bars at once
+        strength = self.currency_strength(np.array([clock_aligned(rsi, data, self.data) for rsi, data in zip(self.rsi, self.datas)]))
 
-            getattr(self.lines, base_currency)[0] += self.rsi[pair_name] * getattr(self.p, pair_name) / (self.total_number_of_currencies - 1)
-            getattr(self.lines, quot_currency)[0] += (100 - self.rsi[pair_name]) * getattr(self.p, pair_name) / (self.total_number_of_currencies - 1)
+        for i, line in enumerate(self.lines):
+            if i < self.total_number_of_currencies:
+                set_line_values(line, start, end, strength[i])
+            else:
+                set_line_values(line, start, end, np.zeros(self.buflen()))
 
 
 class TwentyeightPairsIndicator(bt.Indicator):
@@ -193,36 +473,109 @@ class TwentyeightPairsIndicator(bt.Indicator):
         self.total_number_of_currencies = 8
         self.total_number_of_pairs = 28
 
-        # Two EMAs used for ACS evaluations
-        self.fast_ema = {}
-        self.slow_ema = {}
+        # Two EMAs of each pair used for ACS evaluations
+        self.pair_names = [data._name[0:6] for data in self.datas]
+        if all(is_preloaded(data) for data in self.datas):
+            # EMA arrays are shared with all instances over the same datas, e.g. when only weights are optimized
+            self.fast_ema = [cached_array(data, exponential_moving_average, self.p.fast_ma_period) for data in self.datas]
+            self.slow_ema = [cached_array(data, exponential_moving_average, self.p.slow_ma_period) for data in self.datas]
+            self.addminperiod(max(self.p.fast_ma_period, self.p.slow_ma_period))
+        else:
+            self.fast_ema = [bt.indicators.EMA(data.lines.close, period=self.p.fast_ma_period).lines.ema for data in self.datas]
+            self.slow_ema = [bt.indicators.EMA(data.lines.close, period=self.p.slow_ma_period).lines.ema for data in self.datas]
+
+        # each currency adds up the weighted EMA spreads of pairs it is base of, and subtracts those it is quote of
+        self.weights = np.array([[getattr(self.p, pair_name)] for pair_name in self.pair_names])
+        base, quot = currency_incidence(self.pair_names)
+        self.incidence = base - quot
 
-        for i in range(self.total_number_of_pairs):
-            pair_name = self.datas[i]._name[0:6]
-            self.fast_ema[pair_name] = bt.indicators.EMA(self.datas[i].lines.close, period=self.p.fast_ma_period).ema()
-            self.slow_ema[pair_name] = bt.indicators.EMA(self.datas[i].lines.close, period=self.p.slow_ma_period).ema()
+        # pair lines in the order of the datas, the remaining ones stay 0
+        self.pair_lines = [getattr(self.lines, pair_name) for pair_name in self.pair_names]
+        self.other_lines = [line for line in list(self.lines)[self.total_number_of_currencies:]
+                            if not any(line is pair_line for pair_line in self.pair_lines)]
+
+    def ma_percentage(self, fast_ema, slow_ema):
+        # percentage spread of fast over slow EMA, 0 where slow EMA is 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(slow_ema != 0, (fast_ema - slow_ema) / slow_ema * self.weights, 0)
 
     def next(self):
-        # Initialize each line value for today
-        for line in self.lines:
+        ma_percentage = self.ma_percentage(np.array([[current_value(ema, data)] for ema, data in zip(self.fast_ema, self.datas)]),
+                                           np.array([[current_value(ema, data)] for ema, data in zip(self.slow_ema, self.datas)]))
+        currencies = incidence_product(self.incidence, ma_percentage)
+        pairs = incidence_product(self.incidence.T, currencies)
+
+        for i in range(self.total_number_of_currencies):
+            self.lines[i][0] = currencies[i, 0]
+        for line, value in zip(self.pair_lines, pairs[:, 0]):
+            line[0] = value
+        for line in self.other_lines:
             line[0] = 0
 
-        # Calculate values for each currency line
-        for symbol in self.datas:
-            pair_name = symbol._name[0:6]
-            base_currency = symbol._name[0:3]
-            quot_currency = symbol._name[3:6]
-            if(self.slow_ema[pair_name][0] != 0):
-                ma_percentage = (self.fast_ema[pair_name][0] - self.slow_ema[pair_name][0]) / self.slow_ema[pair_name][0] * getattr(self.p, pair_name)
-            else:
-                ma_percentage = 0
+    def once(self, start, end):
+        # (8, 28) @ (28, T) -> (8, T) currencies, then (28, 8) @ (8, T) -> (28, T) pairs for the whole history at once
+        ma_percentage = self.ma_percentage(np.array([clock_aligned(ema, data, self.data) for ema, data in zip(self.fast_ema, self.datas)]),
+                                           np.array([clock_aligned(ema, data, self.data) for ema, data in zip(self.slow_ema, self.datas)]))
+        currencies = incidence_product(self.incidence, ma_percentage)
+        pairs = incidence_product(self.incidence.T, currencies)
+
+        for i in range(self.total_number_of_currencies):
+            set_line_values(self.lines[i], start, end, currencies[i])
+        for line, values in zip(self.pair_lines, pairs):
+            set_line_values(line, start, end, values)
+        for line in self.other_lines:
+            set_line_values(line, start, end, np.zeros(self.buflen()))
+
+
+class LSTMForecast(bt.Indicator):
+    '''
+    Forecast of the close `n_forecast` bars ahead by a saved model, from the last `n_lookback` closes up to the current bar
+    Same values as the aligned prediction column of add_prediction.py, without writing a csv file first
+    `once` predicts all bars in batches, `next` keeps the scaled closes in a ring buffer and predicts one window per bar
+    '''
+    plotinfo = dict(subplot=False)
+
+    params = (
+        ('model', ''),
+        ('scaler', ''),
+        ('batch_size', 1024),
+    )
+
+    lines = ('forecast',)
+
+    def __init__(self):
+        self.model, self.scaler = load_predictor(self.p.model, self.p.scaler)
+        _, self.n_lookback, _ = self.model.input_shape
+
+        # every value is written twice, so the last n_lookback values are always a contiguous slice
+        self.ring = np.zeros(2 * self.n_lookback, dtype=np.float32)
+        self.ring_index = 0
+
+        self.addminperiod(self.n_lookback)
+
+    def prenext(self):
+        self.push(self.data.close[0])
+
+    def next(self):
+        window = self.push(self.data.close[0])
+        prediction = self.model.predict_on_batch(window.reshape(1, self.n_lookback, 1))
+        self.lines.forecast[0] = float(self.scaler.inverse_transform(np.asarray(prediction, dtype=np.float64).reshape(-1, 1))[-1, 0])
+
+    def push(self, close):
+        # add a close to the ring buffer, returns the last n_lookback scaled closes
+        value = self.scaler.transform([[close]])[0, 0]
+        self.ring[self.ring_index] = self.ring[self.ring_index + self.n_lookback] = value
+        self.ring_index = (self.ring_index + 1) % self.n_lookback
+
+        return self.ring[self.ring_index:self.ring_index + self.n_lookback]
+
+    def once(self, start, end):
+        close = np.frombuffer(self.data.close.array)[:end]
+        windows = lookback_windows(self.scaler.transform(close.reshape(-1, 1)), self.n_lookback)
 
-            getattr(self.lines, base_currency)[0] += ma_percentage
-            getattr(self.lines, quot_currency)[0] -= ma_percentage
+        # window i ends at bar i + n_lookback - 1
+        first = max(start, self.n_lookback - 1)
+        forecast = np.full(end, np.nan)
+        forecast[first:] = predict(self.model, windows[first - self.n_lookback + 1:], self.scaler, batch_size=self.p.batch_size)[:, -1]
 
-        # Calculate 28 symbols values
-        for symbol in self.datas:
-            pair_name = symbol._name[0:6]
-            base_currency = symbol._name[0:3]
-            quot_currency = symbol._name[3:6]
-            getattr(self.lines, pair_name)[0] = getattr(self.lines, base_currency)[0] - getattr(self.lines, quot_currency)[0]
+        set_line_values(self.lines.forecast, start, end, forecast)
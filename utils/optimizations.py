@@ -1,83 +1,521 @@
 from billiard.pool import Pool
+from datetime import datetime
 from celery_progress.backend import ProgressRecorder
 from numbers import Number
 from pathlib import Path
+from sortedcontainers import SortedList
 from tqdm.auto import tqdm
+from utils.analyzers import Pruning
+from utils.caches import EvaluationCache, file_digest
+from utils.results import read_results, results_file, results_writer, write_results
 
 import backtrader as bt
 import collections
-import csv
+import hashlib
+import heapq
+import inspect
 import itertools
+import json
 import math
 import numbers
+import os
 import pandas as pd
 import pickle
+import shutil
 
 PBAR = None
 
+# cerebro of a pool worker, with its datas preloaded by `init_preloaded_worker`
+WORKER_CEREBRO = None
+
+# parameters of `BasicStrategyWithLog` set by the optimizer for early stopping, not by the test cases, left out of the records
+RUN_PARAMS = ('prune_checkpoints', 'prune_below', 'prune_drawdown')
+
+
+def prepare_cerebro(cerebro, **kwargs):
+    '''
+    Set up `cerebro` as `Cerebro.run` does before running strategies, then preload its datas,
+    after which strategies can be run over and over with `cerebro.runstrategies(..., predata=True)`
+    '''
+    cerebro._event_stop = False
+
+    for key, value in kwargs.items():
+        setattr(cerebro.params, key, value)
+
+    bt.linebuffer.LineActions.cleancache()
+    bt.indicator.Indicator.cleancache()
+    bt.linebuffer.LineActions.usecache(cerebro.p.objcache)
+    bt.indicator.Indicator.usecache(cerebro.p.objcache)
+
+    cerebro._dorunonce = cerebro.p.runonce
+    cerebro._dopreload = True
+    cerebro._exactbars = 0
+    cerebro._dooptimize = True  # strategies are returned as OptReturn if optreturn
+
+    # no writers during optimization
+    cerebro.runwriters = list()
+    cerebro.writers_csv = False
+
+    for data in cerebro.datas:
+        data.reset()
+        data.extend(size=cerebro.params.lookahead)
+        data._start()
+        data.preload()
+
+    return cerebro
+
+
+def init_preloaded_worker(cerebro):
+    '''
+    Pool initializer, the cerebro is passed to each worker only once and its datas are preloaded only once
+    '''
+    global WORKER_CEREBRO
+    WORKER_CEREBRO = prepare_cerebro(cerebro, runonce=True, stdstats=False)
+
+
+def run_preloaded_task(task):
+    # only the strategy and its small parameters dict are passed per task
+    strategy, kwargs = task
+
+    # a strategy stopping early with runstop must not stop the next ones
+    WORKER_CEREBRO._event_stop = False
+    return WORKER_CEREBRO.runstrategies([(strategy, (), kwargs)], predata=True)
+
+
+def run_preloaded_record_task(task):
+    # only the flat record goes back to the parent, the strategy itself only if asked for
+    strategy, kwargs, keep_strat = task
+    strat, = run_preloaded_task((strategy, kwargs))
+    return strat_record(strat), strat if keep_strat else None
+
+
+def data_fingerprint(data):
+    '''
+    Parameters of a data feed, with a digest of the content of the file or directory it reads from
+    '''
+    fingerprint = {key: str(value) for key, value in data.p._getkwargs().items()}
+    fingerprint['class'] = type(data).__name__
+
+    dataname = data.p.dataname
+    if isinstance(dataname, (str, os.PathLike)) and os.path.exists(dataname):
+        fingerprint['content'] = file_digest(dataname)
+
+    return fingerprint
+
+
+def strategy_source(strategy):
+    '''
+    Source of a strategy and of its base classes up to the ones of backtrader, so that editing a strategy changes its keys
+    '''
+    sources = []
+    for cls in strategy.__mro__:
+        if cls is object or cls.__module__.startswith('backtrader'):
+            continue
+
+        try:
+            sources.append(inspect.getsource(cls))
+        except (OSError, TypeError):  # defined interactively
+            sources.append(cls.__qualname__)
+
+    return '\n'.join(sources)
+
+
+def evaluation_context(cerebro, strategy):
+    '''
+    Everything besides its parameters a test case result depends on, the strategy source, the broker setup, the analyzers and the datas
+    '''
+    return dict(strategy=hashlib.blake2b(strategy_source(strategy).encode(), digest_size=16).hexdigest(),
+                cash=cerebro.broker.startingcash,
+                commissions={str(name): comminfo.p._getkwargs() for name, comminfo in cerebro.broker.comminfo.items()},
+                analyzers=[(cls.__name__, args, kwargs) for cls, args, kwargs in cerebro.analyzers],
+                datas=[data_fingerprint(data) for data in cerebro.datas])
+
+
+def testcase_key(context, testcase):
+    '''
+    Hash of a test case together with its `evaluation_context`
+    '''
+    key = dict(context, testcase=testcase)
+    return hashlib.blake2b(json.dumps(key, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+
+def strat_record(strat):
+    '''
+    Flat record of a finished strategy, its parameters followed by its flattened analyzer results
+    '''
+    record = {key: value if isinstance(value, numbers.Number) else str(value) for key, value in strat.p._getkwargs().items() if key not in RUN_PARAMS}
+
+    for name_of_analyzer, analyzer in zip(strat.analyzers._names, strat.analyzers._items):
+        if name_of_analyzer in ('tradeanalyzer', 'transactions'):
+            continue
+
+        for name_of_ret, ret in flatten_dict(analyzer.get_analysis()).items():
+            record[f'{name_of_analyzer}_{name_of_ret}'] = ret if isinstance(ret, Number) else str(ret)
+
+    return record
+
 
 class Optimizer:
+    preload_workers = False
+
+    # stream records to `<results_path>.<results_format>` instead of keeping strategies,
+    # only the best `keep_top` strategies by `top_metric` are kept, '-' in front of the metric for the smallest
+    results_path = ''
+    results_format = 'csv'
+
+    # jsonl file of the records of finished test cases, those found there by a rerun are not run again
+    checkpoint = ''
+
+    # SQLite file of records of earlier runs, test cases found there are not run again
+    eval_cache = ''
+    eval_cache_size = 100000
+
+    keep_top = 0
+    top_metric = 'returns_rtot'
+
+    # successive halving on date windows within `halving_range`, off if `halving_eta` is 0
+    halving_eta = 0
+    halving_rungs = 3
+    halving_range = (datetime.min, datetime.max)
+
+    # early stopping of a test case whose value falls below the running median of the completed ones
+    # by more than `prune_margin` of the starting cash at a checkpoint, or whose drawdown exceeds `prune_drawdown`
+    prune_margin = 0.0
+    prune_drawdown = 0.0
+    prune_checkpoints = 10
+    prune_warmup = 8  # completed values needed at a checkpoint before it prunes
+
     def start(self):
-        runstrat = self.cerebro.run(runonce=False, stdstats=False)
+        if self.pruning:
+            self.setup_pruning()
+
+        if self.halving_eta:
+            self.strats, self.strats_df = self.run_successive_halving()
+            return
+
+        if self.results_path:
+            self.strats = self.run_streaming()
+            self.strats_df = read_results(results_file(self.results_path, self.results_format))
+            return
+
+        if self.preload_workers or self.pruning:
+            runstrat = self.run_preloaded_workers()
+        else:
+            runstrat = self.cerebro.run(runonce=False, stdstats=False)
+
         self.strats = [x[0] for x in runstrat]  # flatten 2d list
         self.strats_df = self.build_strats_df()
 
-    def update_progress_bar(self):
-        return
+    def imap_preloaded(self, func, tasks, chunksize=None):
+        '''
+        Yield `func(task)` for every task in order, in a pool whose workers preload the datas once
+        `tasks` without a length are taken a few at a time, each batch once the results of the previous one are consumed
+        '''
+        processes = self.cerebro.p.maxcpus or os.cpu_count()
 
-    def build_strats_df(self):
-        cols = tuple(self.strats[0].p._getkeys())
-        for name_of_analyzer, analyzer in zip(self.strats[0].analyzers._names, self.strats[0].analyzers._items):
-            if name_of_analyzer in ('tradeanalyzer', 'transactions'):
-                continue
+        if processes == 1:
+            init_preloaded_worker(self.cerebro)
+            yield from map(func, tasks)
+            return
+
+        pool = Pool(processes, initializer=init_preloaded_worker, initargs=(self.cerebro,))
 
+        if hasattr(tasks, '__len__'):
+            # a few chunks per worker, small enough to keep workers busy until the end
+            chunksize = chunksize or max(1, len(tasks) // (processes * 8))
+            yield from pool.imap(func, tasks, chunksize=chunksize)
+
+        else:
+            # tasks made on demand, e.g. from the results so far, are only made a few per worker ahead
+            tasks = iter(tasks)
+            for batch in iter(lambda: list(itertools.islice(tasks, processes * 4)), []):
+                yield from pool.imap(func, batch)
+
+        pool.close()
+        pool.join()
+
+    def run_preloaded_workers(self):
+        '''
+        Run every test case of `self.testcases` with `self.strategy` in a pool
+        whose workers preload the datas once and run strategies with runonce
+        '''
+        tasks = ((self.strategy, dict(optimization_dict=testcase, **self.prune_kwargs())) for testcase in self.testcases)
+        if not self.pruning:
+            tasks = list(tasks)
+
+        runstrat = []
+        for r in self.imap_preloaded(run_preloaded_task, tasks):
+            runstrat.append(r)
+            if self.pruning:
+                self.update_pruning(strat_record(r[0]))
+
+            self.bt_opt_callback(r)
+
+        return runstrat
+
+    def run_streaming(self):
+        '''
+        Like `run_preloaded_workers`, but workers return flat records which are appended to
+        `<results_path>.<results_format>` as they arrive, returns the best `keep_top` strategies, best first
+
+        With `checkpoint`, every record is also appended to that file as soon as it arrives, and test cases found there
+        are not run again, so an interrupted run is resumed by running it again with the same checkpoint file
+        With `eval_cache`, records are looked up in and added to an `EvaluationCache` shared by runs
+        '''
+        context = evaluation_context(self.cerebro, self.strategy)
+        if self.pruning:  # pruned records are only reused with the same pruning
+            context['pruning'] = (self.prune_margin, self.prune_drawdown, self.prune_checkpoints, self.prune_warmup)
+        keys = [testcase_key(context, testcase) for testcase in self.testcases]
+        done = self.load_checkpoint() if self.checkpoint else {}
+
+        cache = EvaluationCache(self.eval_cache, self.eval_cache_size) if self.eval_cache else None
+        if cache is not None:
+            done = {**cache.get_many(key for key in keys if key not in done), **done}
+
+        tasks = ((self.strategy, dict(optimization_dict=testcase, **self.prune_kwargs()), self.keep_top > 0)
+                 for testcase, key in zip(self.testcases, keys) if key not in done)
+        if not self.pruning:
+            tasks = list(tasks)
+
+        results = self.imap_preloaded(run_preloaded_record_task, tasks)
+
+        top = []  # min heap of (score, -index, strat), the worst kept strategy on top
+
+        writer = results_writer(self.results_path, self.results_format)
+        if self.checkpoint:
+            Path(self.checkpoint).parent.mkdir(parents=True, exist_ok=True)
+
+        checkpoint = open(self.checkpoint, 'ab') if self.checkpoint else None
+        if checkpoint is not None and checkpoint.tell() > 0:
+            checkpoint.write(b'\n')  # ends a line cut short by an interruption, empty lines are ignored
+
+        # records are written in test case order, checkpointed ones in between those which are run
+        for i, key in enumerate(keys):
+            if key in done:
+                record, strat = done[key], None
             else:
-                rets_dict = analyzer.get_analysis()
-                rets_dict = flatten_dict(rets_dict)
-                for name_of_ret in rets_dict.keys():
-                    cols += (f'{name_of_analyzer}_{name_of_ret}',)
+                record, strat = next(results)
+                if checkpoint is not None:
+                    checkpoint.write(json.dumps(dict(key=key, record=record)).encode() + b'\n')
+                    checkpoint.flush()
+                if cache is not None:
+                    cache.put(key, record)
+
+            writer.append(record)
+            if self.pruning:
+                self.update_pruning(record)
+
+            if self.keep_top > 0:
+                score = self.score(record)
+
+                # ties are kept by the earlier strategy
+                heapq.heappush(top, (score, -i, strat))
+                if len(top) > self.keep_top:
+                    heapq.heappop(top)
+
+            self.bt_opt_callback(record)
+
+        for _ in results:  # lets the pool close
+            pass
+
+        writer.close()
+        if checkpoint is not None:
+            checkpoint.close()
+        if cache is not None:
+            cache.close()
+
+        top = sorted(top, key=lambda x: x[:2], reverse=True)
+
+        # kept strategies which were checkpointed or cached by a previous run are run again
+        rerun = [(self.strategy, dict(optimization_dict=self.testcases[-negative_i]), True) for _, negative_i, strat in top if strat is None]
+        rerun = iter([strat for _, strat in self.imap_preloaded(run_preloaded_record_task, rerun)] if rerun else [])
+
+        return [strat if strat is not None else next(rerun) for _, _, strat in top]
+
+    def score(self, record):
+        '''
+        `top_metric` of a record, larger is better, -inf if missing
+        '''
+        metric, sign = self.top_metric.lstrip('-'), -1 if self.top_metric.startswith('-') else 1
+        score = record.get(metric)
+        return sign * score if isinstance(score, Number) and not math.isnan(score) else -math.inf
+
+    @property
+    def pruning(self):
+        return bool(self.prune_margin or self.prune_drawdown)
+
+    def setup_pruning(self):
+        self.cerebro.addanalyzer(Pruning)
+        self.prune_values = [SortedList() for _ in range(self.prune_checkpoints - 1)]
+
+    def prune_kwargs(self):
+        '''
+        Early stopping parameters of the next test case, the minimum value at each checkpoint from the results so far
+        '''
+        if not self.pruning:
+            return {}
+
+        prune_below = ()
+        if self.prune_margin:
+            margin = self.prune_margin * self.cerebro.broker.startingcash
+            prune_below = tuple(values[len(values) // 2] - margin if len(values) >= self.prune_warmup else None
+                                for values in self.prune_values)
+
+        return dict(prune_checkpoints=self.prune_checkpoints, prune_below=prune_below, prune_drawdown=self.prune_drawdown)
+
+    def update_pruning(self, record):
+        for i, values in enumerate(self.prune_values):
+            value = record.get(f'pruning_value_{i}')
+            if isinstance(value, Number) and not math.isnan(value):
+                values.add(value)
+
+    def halving_windows(self):
+        '''
+        (datetime_from, datetime_before, number of test cases) of every rung of `run_successive_halving`
+        '''
+        fromdate, todate = (datetime.combine(d, datetime.min.time()) if not isinstance(d, datetime) else d for d in self.halving_range)
+
+        windows, n = [], len(self.testcases)
+        for rung in range(self.halving_rungs):
+            fraction = self.halving_eta ** (rung - self.halving_rungs + 1)
+            windows.append((fromdate, fromdate + (todate - fromdate) * fraction, n))
+            n = max(1, math.ceil(n / self.halving_eta))
+
+        return windows
+
+    def run_successive_halving(self):
+        '''
+        Successive halving, every test case is run on a short window at the start of `halving_range`,
+        only the best `1 / halving_eta` of them by `top_metric` go on to a window `halving_eta` times longer,
+        and so on up to the full range in `halving_rungs` rungs
+
+        returns the strategies of the last rung, best first, and the records of every test case at the furthest rung it reached
+        '''
+        candidates = list(range(len(self.testcases)))
+        records, strats = {}, []
+
+        for rung, (datetime_from, datetime_before, _) in enumerate(self.halving_windows()):
+            last = rung == self.halving_rungs - 1
+            tasks = [(self.strategy, dict(optimization_dict={**self.testcases[i], 'datetime_from': datetime_from, 'datetime_before': datetime_before}), last)
+                     for i in candidates]
+
+            for i, (record, strat) in zip(candidates, self.imap_preloaded(run_preloaded_record_task, tasks)):
+                records[i] = dict(record, halving_rung=rung)
+                if last:
+                    strats.append((self.score(record), -i, strat))
+
+                self.bt_opt_callback(record)
+
+            # ties are kept by the earlier test case
+            candidates = sorted(candidates, key=lambda i: (self.score(records[i]), -i), reverse=True)
+            candidates = sorted(candidates[:max(1, math.ceil(len(candidates) / self.halving_eta))])
+
+        strats = [strat for _, _, strat in sorted(strats, key=lambda x: x[:2], reverse=True)]
+        strats_df = pd.DataFrame([records[i] for i in sorted(records)])
+
+        return strats, strats_df
+
+    def load_checkpoint(self):
+        '''
+        Records of the `checkpoint` file by test case key, a line cut short by an interruption is ignored
+        '''
+        done = {}
+        try:
+            with open(self.checkpoint) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+
+                    done[entry['key']] = entry['record']
+
+        except FileNotFoundError:
+            pass
+
+        return done
 
-        df = pd.DataFrame(columns=cols)
-        self.pregress, self.total_testcase = 0, len(self.strats)
+    def bt_opt_callback(self, cb):
+        return
 
-        for strat in self.strats:
-            row = [value if isinstance(value, numbers.Number) else str(value) for value in strat.p._getvalues()]
-            for name_of_analyzer, analyzer in zip(strat.analyzers._names, strat.analyzers._items):
-                if name_of_analyzer in ('tradeanalyzer', 'transactions'):
-                    continue
+    def update_progress_bar(self):
+        return
 
-                else:
-                    rets_dict = analyzer.get_analysis()
-                    rets_dict = flatten_dict(rets_dict)
-                    for ret in rets_dict.values():
-                        row += [ret if isinstance(ret, Number) else str(ret)]
+    def build_strats_df(self):
+        # columns are accumulated as lists and the dataframe is built once,
+        # the flattened key schema is taken from the first strategy
+        schema = tuple(strat_record(self.strats[0])) if self.strats else ()
+        columns = [[] for _ in schema]
+        self.pregress, self.total_testcase = 0, len(self.strats)
 
-            df.loc[len(df)] = row
+        for strat in self.strats:
+            record = strat_record(strat)
+            for key, column in zip(schema, columns):
+                column.append(record.get(key))
 
             self.update_progress_bar()
 
-        return df
+        return pd.DataFrame(dict(zip(schema, columns)), columns=schema)
 
     def save_strats(self, output_path, chunk_size=512):
-        filepath = Path(f'{output_path}.csv')
+        filepath = results_file(output_path, self.results_format)
         filepath.parent.mkdir(parents=True, exist_ok=True)
-        self.strats_df.to_csv(filepath)
+
+        if not self.results_path:
+            write_results(self.strats_df, output_path, self.results_format)
+        elif filepath.resolve() != results_file(self.results_path, self.results_format).resolve():
+            # records have been streamed to disk already, only the best strategies are pickled below
+            if filepath.suffix == '.parquet':
+                shutil.rmtree(filepath, ignore_errors=True)
+                shutil.copytree(results_file(self.results_path, self.results_format), filepath)
+            else:
+                shutil.copyfile(results_file(self.results_path, self.results_format), filepath)
 
         for i in range(math.ceil(len(self.strats) / chunk_size)):
             pickle.dump(self.strats[i * chunk_size: (i + 1) * chunk_size], open(f'{output_path}_{i * chunk_size}_{(i + 1) * chunk_size - 1}.pickle', 'wb'))
 
 
 class OptimizerCLI(Optimizer):
-    def __init__(self, cerebro, strategy, generator, **kwargs):
+    def __init__(self, cerebro, strategy, generator, preload_workers=False,
+                 results_path='', results_format='csv', checkpoint='', eval_cache='', eval_cache_size=100000, keep_top=0, top_metric='returns_rtot',
+                 halving_eta=0, halving_rungs=3, halving_range=(datetime.min, datetime.max),
+                 prune_margin=0.0, prune_drawdown=0.0, prune_checkpoints=10, prune_warmup=8, **kwargs):
         self.cerebro = cerebro
+        self.strategy = strategy
+
+        # random test cases of a run which is resumed or cached must be drawn again the same, see `seeded_random`
+        if (checkpoint or eval_cache) and 'seed' in inspect.signature(generator).parameters and kwargs.get('seed') is None:
+            kwargs['seed'] = 0
+
+        self.testcases = list(generator(**kwargs))
+        self.preload_workers = preload_workers
 
-        total_testcase = sum(1 for _ in generator(**kwargs))
+        self.results_path = results_path
+        self.results_format = results_format
+        self.checkpoint = checkpoint
+        self.eval_cache = eval_cache
+        self.eval_cache_size = eval_cache_size
+        self.keep_top = keep_top
+        self.top_metric = top_metric
+
+        self.halving_eta = halving_eta
+        self.halving_rungs = halving_rungs
+        self.halving_range = halving_range
+
+        self.prune_margin = prune_margin
+        self.prune_drawdown = prune_drawdown
+        self.prune_checkpoints = prune_checkpoints
+        self.prune_warmup = prune_warmup
+
+        # successive halving runs the test cases of every rung
+        total = sum(n for _, _, n in self.halving_windows()) if self.halving_eta else len(self.testcases)
 
         global PBAR
-        PBAR = tqdm(smoothing=0.05, desc='Optimization', total=total_testcase)
+        PBAR = tqdm(smoothing=0.05, desc='Optimization', total=total)
 
-        self.cerebro.optstrategy(strategy, optimization_dict=generator(**kwargs))
-        self.cerebro.optcallback(cb=self.bt_opt_callback)
+        if not (self.preload_workers or self.results_path or self.halving_eta or self.pruning):
+            self.cerebro.optstrategy(strategy, optimization_dict=self.testcases)
+            self.cerebro.optcallback(cb=self.bt_opt_callback)
 
     def bt_opt_callback(self, cb):
         global PBAR
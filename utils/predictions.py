@@ -0,0 +1,197 @@
+from numpy.lib.stride_tricks import sliding_window_view
+from pathlib import Path
+
+import joblib
+import json
+import numpy as np
+
+# activations of the exported layers, sigmoid through tanh so that large inputs do not overflow
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0.0),
+    'tanh': np.tanh,
+    'sigmoid': lambda x: 0.5 * (1.0 + np.tanh(0.5 * x)),
+    'hard_sigmoid': lambda x: np.clip(0.2 * x + 0.5, 0.0, 1.0),
+}
+
+
+def lookback_windows(values, n_lookback, n_windows=None):
+    '''
+    Windows of the last `n_lookback` values before each bar from bar `n_lookback` on, as a read-only strided view
+    of shape (windows, n_lookback, 1) over `values`, no window is copied
+    `n_windows` keeps only the first windows, e.g. those which have `n_forecast` values after them
+    '''
+    values = np.asarray(values).reshape(-1)
+    windows = sliding_window_view(values, n_lookback)[:, :, np.newaxis]
+
+    return windows if n_windows is None else windows[:max(n_windows, 0)]
+
+
+def predict(model, windows, scaler, batch_size=1024):
+    '''
+    Predictions of `model` for all `windows`, `batch_size` windows per call of the model
+    The scaler inverse transform is applied once to all predictions, returns an array of shape (windows, n_forecast)
+    '''
+    _, n_forecast = model.output_shape
+
+    predictions = np.empty((len(windows), n_forecast), dtype=np.float64)
+    for i in range(0, len(windows), batch_size):
+        # only the windows of a batch are copied into a contiguous input of the model
+        batch = np.ascontiguousarray(windows[i:i + batch_size], dtype=np.float32)
+        predictions[i:i + len(batch)] = model.predict_on_batch(batch)
+
+    return scaler.inverse_transform(predictions.reshape(-1, 1)).reshape(predictions.shape)
+
+
+def predict_series(model, scaler, close, batch_size=1024, store=None, key=None):
+    '''
+    Predictions of all lookback windows of the unscaled closes `close`, window i is the bars [i, i + n_lookback)
+    With a `utils.caches.PredictionStore`, `key` identifies the model and only the windows not stored are predicted
+    '''
+    _, n_lookback, _ = model.input_shape
+
+    close = np.asarray(close, dtype=np.float64).reshape(-1)
+    windows = lookback_windows(scaler.transform(close.reshape(-1, 1)), n_lookback)
+    if store is None:
+        return predict(model, windows, scaler, batch_size=batch_size)
+
+    return store.get(key, close, n_lookback, lambda first: predict(model, windows[first:], scaler, batch_size=batch_size))
+
+
+def export_model(model, path):
+    '''
+    Save the weights of a keras Sequential model of LSTM and Dense layers to a `.npz` file run by `NumpyModel`
+    '''
+    meta = dict(input_shape=model.input_shape, output_shape=model.output_shape, layers=[])
+    arrays = {}
+
+    for i, layer in enumerate(model.layers):
+        kind = type(layer).__name__
+        config = layer.get_config()
+        weights = layer.get_weights()
+
+        if kind == 'LSTM':
+            if config['go_backwards'] or config['stateful'] or config.get('time_major'):
+                raise ValueError(f'{layer.name}: only forward, stateless and batch major LSTM layers are exported')
+
+            kernel, recurrent_kernel = weights[:2]
+            bias = weights[2] if config['use_bias'] else np.zeros(kernel.shape[1], dtype=np.float32)
+
+            # inputs and last output are multiplied at once, so both kernels are stacked
+            weights = dict(kernel=np.concatenate((kernel, recurrent_kernel)), bias=bias)
+            spec = dict(kind='lstm', units=config['units'], return_sequences=config['return_sequences'],
+                        activation=config['activation'], recurrent_activation=config['recurrent_activation'])
+
+        elif kind == 'Dense':
+            kernel = weights[0]
+            bias = weights[1] if config['use_bias'] else np.zeros(kernel.shape[1], dtype=np.float32)
+
+            weights = dict(kernel=kernel, bias=bias)
+            spec = dict(kind='dense', activation=config['activation'])
+
+        elif kind in ('InputLayer', 'Dropout'):  # nothing to do at inference
+            continue
+
+        else:
+            raise ValueError(f'{layer.name}: {kind} layers are not exported')
+
+        unknown = {spec[name] for name in ('activation', 'recurrent_activation') if name in spec} - set(ACTIVATIONS)
+        if unknown:
+            raise ValueError(f'{layer.name}: activations {", ".join(sorted(unknown))} are not exported')
+
+        spec['weights'] = []
+        for name, values in weights.items():
+            spec['weights'].append(f'{i}_{name}')
+            arrays[f'{i}_{name}'] = np.asarray(values, dtype=np.float32)
+
+        meta['layers'].append(spec)
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb') as f:
+        np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+
+
+class NumpyModel:
+    '''
+    Model exported by `export_model` run with NumPy only in float32, loaded in milliseconds without TensorFlow
+    Has the `input_shape`, `output_shape` and `predict_on_batch` of a keras model used by `predict`
+    Inputs are run `batch_size` windows at a time, so the outputs of the LSTM layers stay small
+    '''
+
+    def __init__(self, path, batch_size=256):
+        with np.load(path) as f:
+            meta = json.loads(str(f['meta']))
+            self.layers = [(spec, [f[name] for name in spec['weights']]) for spec in meta['layers']]
+
+        self.input_shape = tuple(meta['input_shape'])
+        self.output_shape = tuple(meta['output_shape'])
+        self.batch_size = batch_size
+
+    def predict_on_batch(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        return np.concatenate([self.forward(x[i:i + self.batch_size]) for i in range(0, len(x), self.batch_size)]
+                              or [np.empty((0,) + self.output_shape[1:], dtype=np.float32)])
+
+    def forward(self, x):
+        for spec, weights in self.layers:
+            x = getattr(self, spec['kind'])(x, spec, *weights)
+
+        return x
+
+    @staticmethod
+    def lstm(x, spec, kernel, bias):
+        # keras gates are in the order input, forget, cell and output
+        activation, recurrent_activation = ACTIVATIONS[spec['activation']], ACTIVATIONS[spec['recurrent_activation']]
+        units = spec['units']
+
+        batch, steps, _ = x.shape
+        h = np.zeros((batch, units), dtype=np.float32)
+        c = np.zeros((batch, units), dtype=np.float32)
+        outputs = np.empty((batch, steps, units), dtype=np.float32) if spec['return_sequences'] else None
+
+        for t in range(steps):
+            gates = np.concatenate((x[:, t], h), axis=1) @ kernel + bias
+
+            i = recurrent_activation(gates[:, :units])
+            f = recurrent_activation(gates[:, units:2 * units])
+            g = activation(gates[:, 2 * units:3 * units])
+            o = recurrent_activation(gates[:, 3 * units:])
+
+            c = f * c + i * g
+            h = o * activation(c)
+
+            if outputs is not None:
+                outputs[:, t] = h
+
+        return outputs if outputs is not None else h
+
+    @staticmethod
+    def dense(x, spec, kernel, bias):
+        return ACTIVATIONS[spec['activation']](x @ kernel + bias)
+
+
+# models and scalers loaded from files, shared by all indicators of the process
+PREDICTORS = {}
+
+
+def load_model(path):
+    '''
+    `NumpyModel` of a `.npz` file written by convert_model_to_npz.py, or a keras model of any other file
+    '''
+    if Path(path).suffix == '.npz':
+        return NumpyModel(path)
+
+    # imported here so that processes running exported models never load TensorFlow
+    from tensorflow import keras
+    return keras.models.load_model(path)
+
+
+def load_predictor(model_path, scaler_path):
+    '''
+    Model and scaler saved by 16_lstm_price_prediction_model.py, or exported by convert_model_to_npz.py, loaded once per process
+    '''
+    key = (str(model_path), str(scaler_path))
+    if key not in PREDICTORS:
+        PREDICTORS[key] = (load_model(model_path), joblib.load(scaler_path))
+
+    return PREDICTORS[key]
@@ -0,0 +1,141 @@
+from pathlib import Path
+
+import csv
+import numpy as np
+import pandas as pd
+
+RESULTS_FORMATS = ('csv', 'parquet')
+
+
+def results_file(output_path, results_format):
+    return Path(f'{output_path}.{results_format}')
+
+
+def typed_results(df):
+    '''
+    Give columns a single type for columnar formats, `strat_record` writes missing analyzer values as 'None'
+    so a column of numbers and 'None' becomes numeric with NaN, any other column of mixed values becomes str
+    '''
+    df = df.copy()
+
+    for name in df.select_dtypes(include=['object', 'string']).columns:
+        values = df[name].replace('None', np.nan)
+        try:
+            df[name] = pd.to_numeric(values)
+        except (ValueError, TypeError):
+            df[name] = df[name].astype(str)
+
+    return df
+
+
+class CSVResultsWriter:
+    '''
+    Append records to a single csv file, the first column is the index of the record
+    '''
+
+    def __init__(self, output_path):
+        self.filepath = results_file(output_path, 'csv')
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+
+        self.f = open(self.filepath, 'w', newline='')
+        self.writer = csv.writer(self.f)
+        self.header = None
+        self.index = 0
+
+    def append(self, record):
+        if self.header is None:
+            self.header = list(record.keys())
+            self.writer.writerow([''] + self.header)
+
+        self.writer.writerow([self.index] + [record.get(key, '') for key in self.header])
+        self.index += 1
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetResultsWriter:
+    '''
+    Append records to a parquet dataset, a directory of zstd compressed `part-<n>.parquet` files of `chunk_size` records
+    The schema of all parts is the one of the first part, so the dataset reads back as a single typed table
+    Parts of a previous run in the same directory are removed first
+    '''
+
+    def __init__(self, output_path, chunk_size=4096):
+        self.directory = results_file(output_path, 'parquet')
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for path in self.directory.glob('part-*.parquet'):
+            path.unlink()
+
+        self.chunk_size = chunk_size
+        self.records = []
+        self.schema = None
+        self.parts = 0
+
+    def append(self, record):
+        self.records.append(record)
+        if len(self.records) >= self.chunk_size:
+            self.flush()
+
+    def write(self, df):
+        for i in range(0, len(df), self.chunk_size):
+            self.write_part(df.iloc[i: i + self.chunk_size])
+
+    def flush(self):
+        if self.records:
+            self.write_part(pd.DataFrame(self.records))
+            self.records = []
+
+    def write_part(self, df):
+        # imported here so that only parquet results need pyarrow
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(typed_results(df), schema=self.schema, preserve_index=False)
+        if self.schema is None:
+            self.schema = table.schema
+
+        pq.write_table(table, self.directory / f'part-{self.parts:05d}.parquet', compression='zstd')
+        self.parts += 1
+
+    def close(self):
+        self.flush()
+
+
+def results_writer(output_path, results_format):
+    if results_format == 'csv':
+        return CSVResultsWriter(output_path)
+
+    if results_format == 'parquet':
+        return ParquetResultsWriter(output_path)
+
+    raise ValueError(f'unknown results format {results_format}, one of {RESULTS_FORMATS}')
+
+
+def write_results(df, output_path, results_format):
+    if results_format == 'csv':
+        filepath = results_file(output_path, 'csv')
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        df.to_csv(filepath)
+        return
+
+    writer = results_writer(output_path, results_format)
+    writer.write(df)
+    writer.close()
+
+
+def read_results(input, columns=None):
+    '''
+    Read results written by `write_results` or a results writer, `.csv` file or `.parquet` dataset,
+    only the given columns if any, which is what makes reading a parquet dataset cheap
+    '''
+    if columns is not None:
+        columns = list(dict.fromkeys(columns))  # plots may ask for the same column twice
+
+    if str(input).endswith('.csv'):
+        if columns is None:
+            return pd.read_csv(input, index_col=0)
+
+        return pd.read_csv(input, usecols=lambda name: name in columns)[columns]
+
+    return pd.read_parquet(input, columns=columns)
@@ -1,4 +1,5 @@
 from utils.constants import *
+from utils.datafeeds import window_indices
 from utils.indicators import *
 from utils.observers import BuySellArrows
 
@@ -7,9 +8,122 @@ from sortedcontainers import SortedDict
 
 import math
 import backtrader as bt
+import numpy as np
+
+# bars of preloaded datas at which the periods of time frame analyzers change, see `period_boundaries`
+PERIOD_BOUNDARIES = {}
+
+
+def period_boundaries(analyzer, data):
+    '''
+    (bar, dtcmp, dtkey) of the bars of a preloaded data at which `analyzer` starts a new period, as found by its `_dt_over`,
+    computed once per process for each data, timeframe and compression
+    '''
+    key = (preloaded_fingerprint(data), analyzer.timeframe, analyzer.compression)
+    if key not in PERIOD_BOUNDARIES:
+        if analyzer.timeframe == bt.TimeFrame.NoTimeFrame:
+            boundaries = [(0, bt.utils.py3.MAXINT, datetime.max)]
+        else:
+            boundaries = []
+            for bar, dtnum in enumerate(np.frombuffer(data.datetime.array)[:data.buflen()]):
+                dtcmp, dtkey = analyzer._get_dt_cmpkey(data.num2date(dtnum))
+                if not boundaries or dtcmp > boundaries[-1][1]:
+                    boundaries.append((bar, dtcmp, dtkey))
+
+        PERIOD_BOUNDARIES[key] = boundaries
+
+    return PERIOD_BOUNDARIES[key]
 
 
 class BasicStrategyWithLog(bt.Strategy):
+    params = (
+        # early stopping during optimization, set by the optimizer
+        ('prune_checkpoints', 0),  # the value is checked at this many evenly spaced bars, 0 is off
+        ('prune_below', ()),  # minimum value at each checkpoint, None for no minimum
+        ('prune_drawdown', 0.0),  # largest drawdown from the peak value, as a fraction, 0 is off
+    )
+
+    def start(self):
+        # window bounds as date numbers, compared with the datetime line in next instead of converting every bar
+        self.dtnum_from = self.datas[0].date2num(getattr(self.p, 'datetime_from', datetime.min))
+        self.dtnum_before = self.datas[0].date2num(getattr(self.p, 'datetime_before', datetime.max))
+
+        # lengths of the data at which the value is checked, evenly spaced over the bars of the window,
+        # the datas are preloaded during optimization
+        start, end = window_indices(self.datas[0], self.dtnum_from, self.dtnum_before)
+        self.checkpoint_bars = {start + math.ceil((end - start) * i / self.p.prune_checkpoints): i - 1 for i in range(1, self.p.prune_checkpoints)}
+        self.checkpoint_values = {}  # by checkpoint index, checkpoints which are never reached are missing
+        self.peak_value = self.broker.getvalue()
+        self.pruned = False
+
+    def notify_cashvalue(self, cash, value):
+        if self.pruned:
+            return
+
+        if self.p.prune_drawdown:
+            self.peak_value = max(self.peak_value, value)
+            if value < self.peak_value * (1 - self.p.prune_drawdown):
+                self.prune()
+                return
+
+        i = self.checkpoint_bars.get(len(self.datas[0]))
+        if i is not None:
+            self.checkpoint_values[i] = value
+
+            if i < len(self.p.prune_below) and self.p.prune_below[i] is not None and value < self.p.prune_below[i]:
+                self.prune()
+
+    def _once(self):
+        super()._once()
+
+        # runonce has computed the indicators over all bars, so the bars before the window
+        # are skipped instead of being iterated only to return early from next
+        for data in self.datas:
+            skip, _ = window_indices(data, self.dtnum_from, self.dtnum_before)
+            if skip > 0:
+                data.advance(size=skip)
+
+        # in order of creation, so that clocks which are indicators have been advanced first
+        for indicator in self._lineiterators[bt.LineIterator.IndType]:
+            skip = len(indicator._clock) - len(indicator)
+            if skip > 0:
+                indicator.advance(size=skip)
+
+        skip, _ = window_indices(self.datas[0], self.dtnum_from, self.dtnum_before)
+        self.replay_periods(skip)
+
+    def replay_periods(self, bars):
+        '''
+        Let the time frame analyzers such as Returns and SharpeRatio see the periods of the first `bars` bars skipped by _once,
+        in which the value is the starting cash, so that their averages are over all bars as if they had been iterated
+        '''
+        if bars <= 0:
+            return
+
+        broker = self.broker
+        analyzers = list(self.analyzers)
+        while analyzers:
+            analyzer = analyzers.pop()
+            analyzers.extend(analyzer._children)
+            if not isinstance(analyzer, bt.TimeFrameAnalyzerBase):
+                continue
+
+            analyzer.notify_fund(broker.getcash(), broker.getvalue(), broker.fundvalue, broker.fundshares)
+            for bar, dtcmp, dtkey in period_boundaries(analyzer, self.datas[0]):
+                if bar >= bars:
+                    break
+
+                # as _next of the analyzer when _dt_over finds a new period
+                analyzer.dtkey, analyzer.dtkey1 = dtkey, analyzer.dtkey
+                analyzer.dtcmp, analyzer.dtcmp1 = dtcmp, analyzer.dtcmp
+                analyzer.on_dt_over()
+                analyzer.next()
+
+    def prune(self):
+        self.log(f'PRUNED, Value: {self.broker.getvalue():.2f}')
+        self.pruned = True
+        self.env.runstop()
+
     def log(self, txt, dt=None, doprint=False):
         ''' Logging function fot this strategy'''
         if self.params.print_log or doprint:
@@ -68,10 +182,10 @@ class BuyAndHold(BasicStrategyWithLog):
                 setattr(self.p, key, value)
 
     def next(self):
-        if self.datas[0].datetime.datetime(0) < self.p.datetime_from:
+        if self.datas[0].datetime[0] < self.dtnum_from:
             return
 
-        elif self.datas[0].datetime.datetime(0) >= self.p.datetime_before:
+        elif self.datas[0].datetime[0] >= self.dtnum_before:
             if self.position:
                 self.close()
             else:
@@ -111,18 +225,19 @@ class MovingAveragesCrossover(BasicStrategyWithLog):
         if 'JPY' in self.datas[0]._name:
             self.p.one_lot_size /= 100
 
-        self.fast_sma = fast_sma = bt.ind.SMA(period=self.p.fast_ma_period)  # fast moving average
-        self.slow_sma = slow_sma = bt.ind.SMA(period=self.p.slow_ma_period)  # slow moving average
-        self.crossover = bt.ind.CrossOver(fast_sma, slow_sma)  # crossover signal
+        # computed once per process and shared by strategies of the same periods, e.g. of sliding windows
+        self.fast_sma = fast_sma = shared_indicator(bt.ind.SMA, self.datas[0], period=self.p.fast_ma_period)  # fast moving average
+        self.slow_sma = slow_sma = shared_indicator(bt.ind.SMA, self.datas[0], period=self.p.slow_ma_period)  # slow moving average
+        self.crossover = shared_indicator(bt.ind.CrossOver, fast_sma, slow_sma)  # crossover signal
 
         if self.p.use_strength:
             self.strength = bt.ind.SMA(abs(fast_sma - fast_sma(-1)), period=1, subplot=True)
 
     def next(self):
-        if self.datas[0].datetime.datetime(0) < self.p.datetime_from:
+        if self.datas[0].datetime[0] < self.dtnum_from:
             return
 
-        elif self.datas[0].datetime.datetime(0) >= self.p.datetime_before:
+        elif self.datas[0].datetime[0] >= self.dtnum_before:
             if self.position:
                 self.close()
             else:
@@ -198,7 +313,8 @@ class RSIPositionSizing(BasicStrategyWithLog):
         self.max_buy_position = self.p.one_lot_size
         self.max_sell_position = self.p.one_lot_size
 
-        self.rsi = bt.ind.RSI(period=self.p.period, upperband=self.p.upperband, lowerband=self.p.lowerband, safediv=True)
+        # computed once per process and shared by strategies of the same parameters, e.g. of sliding windows
+        self.rsi = shared_indicator(bt.ind.RSI, self.datas[0], period=self.p.period, upperband=self.p.upperband, lowerband=self.p.lowerband, safediv=True)
 
         self.buy_signal = self.rsi <= self.p.lowerband
         self.sell_signal = self.rsi >= self.p.upperband
@@ -206,14 +322,14 @@ class RSIPositionSizing(BasicStrategyWithLog):
         self.stop_buy_signal = self.rsi >= self.p.lower_unwind
         self.stop_sell_signal = self.rsi <= self.p.upper_unwind
 
-        self.normal_rsi_buy_signal = bt.ind.CrossOver(self.rsi, self.p.lowerband, plot=False)
-        self.normal_rsi_sell_signal = bt.ind.CrossOver(self.rsi, self.p.upperband, plot=False)
+        self.normal_rsi_buy_signal = shared_indicator(bt.ind.CrossOver, self.rsi, self.p.lowerband, plot=False)
+        self.normal_rsi_sell_signal = shared_indicator(bt.ind.CrossOver, self.rsi, self.p.upperband, plot=False)
 
     def next(self):
-        if self.datas[0].datetime.datetime(0) < self.p.datetime_from:
+        if self.datas[0].datetime[0] < self.dtnum_from:
             return
 
-        elif self.datas[0].datetime.datetime(0) >= self.p.datetime_before:
+        elif self.datas[0].datetime[0] >= self.dtnum_before:
             if self.position:
                 self.close()
             else:
@@ -349,10 +465,10 @@ class CurrencyStrength(BasicStrategyWithLog):
         self.last_open_position_time = dict()
 
     def next(self):
-        if self.datas[0].datetime.datetime(0) < self.p.datetime_from:
+        if self.datas[0].datetime[0] < self.dtnum_from:
             return
 
-        elif self.datas[0].datetime.datetime(0) >= self.p.datetime_before:
+        elif self.datas[0].datetime[0] >= self.dtnum_before:
             if self.position:
                 self.close()
             else:
@@ -474,6 +590,9 @@ class ACSTrailing(BasicStrategyWithLog):
 
         ('plot_ask_acs', False),
 
+        ('datetime_from', datetime.min),
+        ('datetime_before', datetime.max),
+
         ('fast_ma_period', 3),
         ('slow_ma_period', 20),
 
@@ -539,10 +658,10 @@ class ACSTrailing(BasicStrategyWithLog):
         self.last_open_position_time = dict()
 
     def next(self):
-        if self.datas[0].datetime.datetime(0) < self.p.datetime_from:
+        if self.datas[0].datetime[0] < self.dtnum_from:
             return
 
-        elif self.datas[0].datetime.datetime(0) >= self.p.datetime_before:
+        elif self.datas[0].datetime[0] >= self.dtnum_before:
             if self.position:
                 self.close()
             else:
@@ -710,10 +829,10 @@ class ShiftPrediction(BasicStrategyWithLog):
         self.order = None
 
     def next(self):
-        if self.datas[0].datetime.datetime(0) < self.p.datetime_from:
+        if self.datas[0].datetime[0] < self.dtnum_from:
             return
 
-        elif self.datas[0].datetime.datetime(0) >= self.p.datetime_before:
+        elif self.datas[0].datetime[0] >= self.dtnum_before:
             if self.position:
                 self.close()
             else:
@@ -722,7 +841,7 @@ class ShiftPrediction(BasicStrategyWithLog):
         else:
             size = self.p.one_lot_size
 
-            print(self.datas[0].datetime.datetime(0), self.forecast_price[0])
+            self.log(f'Forecast: {self.forecast_price[0]:.5f}', dt=self.datas[0].datetime.datetime(0))
 
             if not self.position:
                 if self.forecast_price[0] > self.datas[0].close[0]:
@@ -765,6 +884,11 @@ class ForecastTrading(BasicStrategyWithLog):
         ('stoptype', bt.Order.StopTrail),
         ('trailamount', 0.01000),
         ('trailpercent', 0.00008),
+
+        # saved model and scaler forecasting on the fly, the openinterest line is the forecast if not given
+        ('model', ''),
+        ('scaler', ''),
+        ('batch_size', 1024),
     )
 
     def __init__(self):
@@ -777,16 +901,19 @@ class ForecastTrading(BasicStrategyWithLog):
             self.p.trailamount *= 100
             self.p.trailpercent *= 100
 
-        self.forecast_price = bt.ind.SMA(self.datas[0].openinterest, period=1)
+        if self.p.model:
+            self.forecast_price = LSTMForecast(self.datas[0], model=self.p.model, scaler=self.p.scaler, batch_size=self.p.batch_size)
+        else:
+            self.forecast_price = bt.ind.SMA(self.datas[0].openinterest, period=1)
 
         self.last_open_position = None
         self.order = None
 
     def next(self):
-        if self.datas[0].datetime.datetime(0) < self.p.datetime_from:
+        if self.datas[0].datetime[0] < self.dtnum_from:
             return
 
-        elif self.datas[0].datetime.datetime(0) >= self.p.datetime_before:
+        elif self.datas[0].datetime[0] >= self.dtnum_before:
             if self.position:
                 self.close()
             else:
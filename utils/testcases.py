@@ -4,6 +4,12 @@ import math
 import random
 
 
+def seeded_random(seed, *args):
+    # with a seed, random test cases are drawn from it and the arguments of their generator, so a rerun gets the same ones,
+    # without one they are drawn from the global random module
+    return random if seed is None else random.Random(repr((seed,) + args))
+
+
 def slides_generator(datetime_from, datetime_before, durations, steps, **kwargs):
     input_datetime_from = datetime.combine(datetime_from, datetime.min.time())
     input_datetime_before = datetime.combine(datetime_before, datetime.min.time())
@@ -30,7 +36,7 @@ def slides_generator(datetime_from, datetime_before, durations, steps, **kwargs)
                     datetime_from += step
 
 
-def sma_testcase_generator(n=0, max_period=1):
+def sma_testcase_generator(n=0, max_period=1, seed=None):
     n = int(n)
     max_period = int(max_period) + 1
 
@@ -42,8 +48,9 @@ def sma_testcase_generator(n=0, max_period=1):
                            slow_ma_period=slow_ma_period,
                            )
     else:
+        rng = seeded_random(seed, 'sma', n, max_period)
         for _ in range(n):
-            fast_ma_period, slow_ma_period = random.sample(range(1, max_period), 2)
+            fast_ma_period, slow_ma_period = rng.sample(range(1, max_period), 2)
             for use_strength in (True, False):
                 for strength in (0.0001, 0.0005, 0.0010):
                     yield dict(use_strength=use_strength,
@@ -53,7 +60,7 @@ def sma_testcase_generator(n=0, max_period=1):
                                )
 
 
-def sma_strength_testcase_generator(n=0, max_period=1, max_strength=0.001, strength_step=0.0001):
+def sma_strength_testcase_generator(n=0, max_period=1, max_strength=0.001, strength_step=0.0001, seed=None):
     n = int(n)
     max_period = int(max_period) + 1
 
@@ -72,9 +79,10 @@ def sma_strength_testcase_generator(n=0, max_period=1, max_strength=0.001, stren
                                slow_ma_period=slow_ma_period,
                                )
     else:
+        rng = seeded_random(seed, 'sma_strength', n, max_period, max_strength, strength_step)
         for _ in range(n):
-            fast_ma_period, slow_ma_period = random.sample(range(1, max_period), 2)
-            strength = random.uniform(0, max_strength)
+            fast_ma_period, slow_ma_period = rng.sample(range(1, max_period), 2)
+            strength = rng.uniform(0, max_strength)
             yield dict(use_strength=strength != 0,
                        strength=strength,
                        fast_ma_period=fast_ma_period,
@@ -83,7 +91,7 @@ def sma_strength_testcase_generator(n=0, max_period=1, max_strength=0.001, stren
 
 
 def rsi_testcase_generator(n=0, max_period=1, lowerband_from=30.0, lowerband_to=40.0,
-                           upperband_from=60.0, upperband_to=70.0, wind_step=1.0):
+                           upperband_from=60.0, upperband_to=70.0, wind_step=1.0, seed=None):
     n = int(n)
     max_period = int(max_period) + 1
 
@@ -104,10 +112,11 @@ def rsi_testcase_generator(n=0, max_period=1, lowerband_from=30.0, lowerband_to=
         i = math.ceil((lowerband_to - lowerband_from) / wind_step)
         j = math.ceil((upperband_to - upperband_from) / wind_step)
 
+        rng = seeded_random(seed, 'rsi', n, max_period, lowerband_from, lowerband_to, upperband_from, upperband_to, wind_step)
         for _ in range(n):
-            period = random.randint(1, max_period)
-            lowerband = lowerband_from + random.randrange(i) * wind_step
-            upperband = upperband_from + random.randrange(j) * wind_step
+            period = rng.randint(1, max_period)
+            lowerband = lowerband_from + rng.randrange(i) * wind_step
+            upperband = upperband_from + rng.randrange(j) * wind_step
             yield dict(use_strength=True,
                        period=period,
                        lowerband=lowerband,
@@ -116,7 +125,7 @@ def rsi_testcase_generator(n=0, max_period=1, lowerband_from=30.0, lowerband_to=
 
 
 def rsi_sizing_testcase_generator(n=0, max_period=1, size_multiplier_from=0.0, size_multiplier_to=0.5, size_step=0.05,
-                                  lowerband_from=30.0, lowerband_to=40.0, upperband_from=60.0, upperband_to=70.0, wind_step=5.0):
+                                  lowerband_from=30.0, lowerband_to=40.0, upperband_from=60.0, upperband_to=70.0, wind_step=5.0, seed=None):
 
     n = int(n)
     max_period = int(max_period) + 1
@@ -141,8 +150,11 @@ def rsi_sizing_testcase_generator(n=0, max_period=1, size_multiplier_from=0.0, s
         i = math.ceil((lowerband_to - lowerband_from) / wind_step)
         j = math.ceil((upperband_to - upperband_from) / wind_step)
         k = math.ceil((size_multiplier_to - size_multiplier_from) / size_step)
+
+        rng = seeded_random(seed, 'rsi_sizing', n, max_period, size_multiplier_from, size_multiplier_to, size_step,
+                            lowerband_from, lowerband_to, upperband_from, upperband_to, wind_step)
         for _ in range(n):
-            period = random.randint(1, max_period)
+            period = rng.randint(1, max_period)
             lowerband = lowerband_from + i * wind_step
             upperband = upperband_from + j * wind_step
             size_multiplier = size_multiplier_from + k * size_step
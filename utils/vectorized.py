@@ -0,0 +1,640 @@
+from backtrader.mathsupport import average, standarddev
+from types import SimpleNamespace
+from utils.commissions import ForexCommission
+from utils.indicators import crossover, relative_strength_index, simple_moving_average
+from utils.optimizations import RUN_PARAMS, prepare_cerebro, strat_record
+from utils.strategies import ForecastTrading, MovingAveragesCrossover, RSIPositionSizing, ShiftPrediction
+
+import backtrader as bt
+import bisect
+import math
+import numbers
+import numpy as np
+
+
+def trail_levels(close, isbuy, trailamount, trailpercent):
+    # stop level each close moves a trailing stop to, as `bt.Order.trailadjust`
+    if trailamount:
+        amount = trailamount
+    elif trailpercent:
+        amount = close * trailpercent
+    else:
+        amount = 0.0
+
+    return close + amount if isbuy else close - amount
+
+
+def same_value(a, b, rel_tol=1e-9, abs_tol=1e-9):
+    if isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
+        return a == b or math.isclose(a, b, rel_tol=rel_tol, abs_tol=abs_tol) or (math.isnan(a) and math.isnan(b))
+
+    return a == b
+
+
+class PeriodKeys:
+    '''
+    Comparison keys of the periods of a `bt.TimeFrameAnalyzerBase`, e.g. `Returns` and the `TimeReturn` of `SharpeRatio`
+    '''
+    _get_dt_cmpkey = bt.TimeFrameAnalyzerBase._get_dt_cmpkey
+    _get_subday_cmpkey = bt.TimeFrameAnalyzerBase._get_subday_cmpkey
+
+    def __init__(self, timeframe, compression):
+        self.timeframe = timeframe
+        self.compression = compression
+
+    def ranks(self, dts):
+        # rank of the key of each datetime, a period starts where the rank is larger than all before
+        keys = [self._get_dt_cmpkey(dt)[0] for dt in dts]
+        ranks = {key: i for i, key in enumerate(sorted(set(keys)))}
+        return np.array([ranks[key] for key in keys], dtype=np.int64)
+
+
+class Order:
+    '''
+    Market order, or trailing stop order if it has `trail` levels, `price` is the created price of `bt.Order`
+    '''
+
+    def __init__(self, size, price, trail=None):
+        self.size = size
+        self.price = price
+        self.trail = trail
+
+    def isbuy(self):
+        return self.size > 0
+
+
+class Account:
+    '''
+    Cash and position of `bt.BackBroker` with a single data and `ForexCommission`, same operations in the same order
+    Only the bars at which the cash or the position change are recorded, bars in between hold the values before them
+    '''
+
+    def __init__(self, engine, start):
+        self.engine = engine
+        self.comminfo = engine.comminfo
+        self.cash = engine.cash
+        self.position = bt.Position()
+
+        self.bar = start - 1  # last settled bar
+        self.changes = [(0, self.cash, 0.0, 0.0)]  # flat from the first bar, the analyzers see the bars before the window too
+
+    def credit_size(self):
+        # size charged with credit interest, as `get_credit_interest`, None if it is not charged
+        size = self.position.size
+        if not size or (size > 0 and not self.comminfo.p.interest_long):
+            return None
+
+        return abs(size)
+
+    def advance(self, bar):
+        # bars after the last settled one up to `bar`, in which nothing is executed
+        size = self.credit_size()
+        if size is not None:
+            # intraday bars have no credit interest, only the first bar of a day is charged
+            day_bars = self.engine.day_bars
+            for i in day_bars[bisect.bisect_right(day_bars, self.bar):bisect.bisect_right(day_bars, bar)]:
+                self.credit(i)
+                self.settle(i)
+
+        self.bar = max(self.bar, bar)
+
+    def credit(self, bar):
+        size = self.credit_size()
+        days = self.engine.days[bar]
+        if size is not None and days:
+            self.cash -= days * self.comminfo._creditrate * size
+
+    def settle(self, bar):
+        self.changes.append((bar, self.cash, self.position.size, self.position.price))
+        self.bar = bar
+
+    def history(self, start, stop):
+        # cash, size and price after each bar from `start` to `stop`
+        bars, cashes, sizes, prices = (np.array(values) for values in zip(*self.changes))
+        i = np.searchsorted(bars, np.arange(start, stop + 1), side='right') - 1
+        return cashes[i], sizes[i], prices[i]
+
+    def check(self, orders):
+        '''
+        Orders accepted by `check_submitted`, pseudo executed one after another at their created prices,
+        rejected if the cash left would be negative
+        '''
+        if not orders:
+            return []
+
+        comminfo = self.comminfo
+        cash = self.cash
+        position = self.position.clone()
+
+        accepted = []
+        for order in orders:
+            price = order.price
+            psize, pprice, opened, closed = position.update(order.size, price)
+
+            if closed:
+                closedvalue = comminfo.getvaluesize(-closed, price)
+                if closedvalue > 0:
+                    closedvalue /= comminfo.get_leverage()
+
+                cash += closedvalue
+                cash -= comminfo.getcommission(closed, price)
+
+            if opened:
+                openedvalue = comminfo.getvaluesize(opened, price)
+                if openedvalue > 0:
+                    openedvalue /= comminfo.get_leverage()
+
+                cash -= openedvalue
+                cash -= comminfo.getcommission(opened, price)
+
+            if cash >= 0.0:
+                accepted.append(order)
+
+        return accepted
+
+    def execute(self, size, price):
+        # `BackBroker._execute`, the opened part is dropped if the cash left would be negative
+        comminfo = self.comminfo
+        position = self.position
+
+        pprice_orig = position.price
+        psize, pprice, opened, closed = position.pseudoupdate(size, price)
+        pnl = comminfo.profitandloss(-closed, pprice_orig, price)
+
+        cash = self.cash
+        if closed:
+            closedvalue = comminfo.getvaluesize(-closed, pprice_orig)
+            if closedvalue > 0:
+                closedvalue /= comminfo.get_leverage()
+
+            cash += closedvalue + pnl * comminfo.stocklike
+            cash -= comminfo.getcommission(closed, price)
+            self.cash = cash
+
+        if opened:
+            openedvalue = comminfo.getvaluesize(opened, price)
+            if openedvalue > 0:
+                openedvalue /= comminfo.get_leverage()
+
+            cash -= openedvalue
+            cash -= comminfo.getcommission(opened, price)
+
+            if cash < 0.0:
+                opened = 0
+            else:
+                self.cash = cash
+
+        if closed + opened:
+            position.update(closed + opened, price)
+
+
+class Rule:
+    '''
+    Trading rule of a strategy over arrays, `orders` are the orders the strategy submits at a bar given its position
+    and `next_bar` the first bar after it at which it may submit any, the bars in between are skipped
+    Masks of the bars with a signal are given for flat, long and short positions
+    '''
+    first_bar = 0  # first bar of next, the minimum period of the strategy minus 1
+
+    def __init__(self, engine, p):
+        self.engine = engine
+        self.p = p
+        self.events = {sign: np.flatnonzero(mask).tolist() for sign, mask in self.masks.items()}
+
+    def next_bar(self, bar, size):
+        events = self.events[sign(size)]
+        i = bisect.bisect_right(events, bar)
+        return events[i] if i < len(events) else None
+
+    def orders(self, bar, size):
+        if not self.masks[sign(size)][bar]:
+            return []
+
+        return self.signal(bar, size)
+
+    def market(self, bar, size):
+        return [Order(size, float(self.engine.close[bar]))] if size else []
+
+
+class MovingAveragesCrossoverRule(Rule):
+    def __init__(self, engine, p):
+        if 'JPY' in engine.name:
+            p.one_lot_size /= 100
+
+        fast = engine.indicator(simple_moving_average, 'close', p.fast_ma_period)
+        slow = engine.indicator(simple_moving_average, 'close', p.slow_ma_period)
+        self.crossover = crossover(fast, slow)
+        self.first_bar = first_valid(self.crossover)
+
+        signal = self.crossover != 0.0
+        if p.use_strength:
+            # the strength of the first valid bar uses the bar before it, the SMA of period 1 is the value itself
+            self.strength = np.abs(fast - np.concatenate(([np.nan], fast[:-1])))
+            self.weak = self.strength < p.strength
+            signal &= ~self.weak
+
+        self.masks = {0: signal & ~np.isnan(self.crossover), 1: self.crossover < 0.0, -1: self.crossover > 0.0}
+        super().__init__(engine, p)
+
+    def signal(self, bar, size):
+        lot = self.p.one_lot_size
+        if not size:
+            target = -lot if self.crossover[bar] < 0.0 else lot
+        else:
+            target = lot if size < 0 else -lot
+            if self.p.use_strength and self.weak[bar]:
+                target = 0
+
+        return self.market(bar, target - size)
+
+
+class RSIPositionSizingRule(Rule):
+    def __init__(self, engine, p):
+        if p.use_strength:
+            raise ValueError('RSIPositionSizing with use_strength sizes by the RSI of each bar, it is not simulated')
+
+        if 'JPY' in engine.name:
+            p.one_lot_size /= 100
+
+        rsi = engine.indicator(relative_strength_index, 'close', p.period, True)
+        buy_crossover = crossover(rsi, p.lowerband)
+        self.buy_signal = buy_crossover > 0.0
+        self.sell_signal = crossover(rsi, p.upperband) < 0.0
+        self.first_bar = first_valid(buy_crossover)
+
+        self.masks = {0: self.buy_signal | self.sell_signal, 1: self.sell_signal, -1: self.buy_signal}
+        super().__init__(engine, p)
+
+    def signal(self, bar, size):
+        if not size:
+            return self.market(bar, self.p.one_lot_size if self.buy_signal[bar] else -self.p.one_lot_size)
+
+        return self.market(bar, -size - size)
+
+
+class TrailingStopRule(Rule):
+    '''
+    Market order on a forecast, then a trailing stop order closing the position once it is open
+    '''
+    trail = None  # name of the trailing stop parameter used by the strategy
+
+    def __init__(self, engine, p):
+        if p.stoptype != bt.Order.StopTrail:
+            raise ValueError(f'{type(self).__name__[:-4]} is only simulated with stoptype StopTrail')
+
+        if 'JPY' in engine.name:
+            p.one_lot_size /= 100
+            p.trailamount *= 100
+            p.trailpercent *= 100
+
+        self.last_open_position = None  # sign of the last market order
+        self.order = None
+
+        self.masks = {0: self.buy_signal | self.sell_signal}
+        self.first_bar = first_valid(self.forecast)
+        super().__init__(engine, p)
+
+    def next_bar(self, bar, size):
+        # in the market, the stop order is submitted at the bar the position is opened and the rule waits for it
+        return super().next_bar(bar, size) if not size else None
+
+    def orders(self, bar, size):
+        lot = self.p.one_lot_size
+        if not size:
+            orders = []
+            if self.buy_signal[bar]:
+                orders = self.market(bar, lot)
+                self.last_open_position = 1
+
+            elif self.sell_signal[bar]:
+                orders = self.market(bar, -lot)
+                self.last_open_position = -1
+
+            self.order = None
+            return orders
+
+        if self.order is None and self.last_open_position:
+            isbuy = self.last_open_position < 0
+            kwargs = {self.trail: getattr(self.p, self.trail)}
+            trail = self.engine.indicator(trail_levels, 'close', isbuy, kwargs.get('trailamount'), kwargs.get('trailpercent'))
+
+            self.order = Order(lot if isbuy else -lot, float(trail[bar]), trail)
+            return [self.order]
+
+        return []
+
+
+class ShiftPredictionRule(TrailingStopRule):
+    trail = 'trailpercent'
+
+    def __init__(self, engine, p):
+        if p.shift < 0:
+            raise ValueError('ShiftPrediction with a negative shift looks ahead, it is not simulated')
+
+        close = engine.close
+        self.forecast = np.full(len(close), np.nan)
+        self.forecast[p.shift:] = close[:len(close) - p.shift]
+
+        self.buy_signal = self.forecast > close
+        self.sell_signal = self.forecast < close
+        super().__init__(engine, p)
+
+
+class ForecastTradingRule(TrailingStopRule):
+    trail = 'trailamount'
+
+    def __init__(self, engine, p):
+        if p.model:
+            raise ValueError('ForecastTrading with a model forecasts in the indicator, it is not simulated')
+
+        close = engine.close
+        self.forecast = engine.openinterest
+
+        self.buy_signal = self.forecast > (1 + p.delta) * close
+        self.sell_signal = self.forecast < (1 - p.delta) * close
+        super().__init__(engine, p)
+
+
+def sign(size):
+    return (size > 0) - (size < 0)
+
+
+def first_valid(values):
+    valid = np.flatnonzero(~np.isnan(values))
+    return int(valid[0]) if len(valid) else len(values)
+
+
+class VectorizedBacktest:
+    '''
+    Coarse and fast first pass for large sweeps of single symbol strategies, the record of a test case without backtrader
+    Orders are filled at the open of the next bar with the cash, commissions and credit interest of `BackBroker`
+    and `ForexCommission`, and the analyzers of `get_default_cerebro` are computed over the values of all bars,
+    only the bars with a signal or an order are iterated, the others are settled with arrays
+    Records are those of `strat_record`, `validate` runs a test case with backtrader as well and reports differences
+    '''
+    RULES = {
+        MovingAveragesCrossover: MovingAveragesCrossoverRule,
+        RSIPositionSizing: RSIPositionSizingRule,
+        ShiftPrediction: ShiftPredictionRule,
+        ForecastTrading: ForecastTradingRule,
+    }
+
+    def __init__(self, columns, name='', cash=200000, comminfo=None, timeframe=bt.TimeFrame.Minutes, compression=60):
+        self.comminfo = comminfo = comminfo if comminfo is not None else ForexCommission()
+        if not (isinstance(comminfo, ForexCommission) and comminfo.stocklike):
+            raise ValueError('only a stocklike ForexCommission is simulated')
+
+        self.name = name
+        self.cash = cash
+        self.timeframe = timeframe
+        self.cerebro = None
+
+        self.datetime, self.open, self.high, self.low, self.close, self.openinterest = (
+            np.asarray(columns[name], dtype=np.float64) for name in ('datetime', 'open', 'high', 'low', 'close', 'openinterest'))
+        self.buflen = len(self.datetime)
+
+        # days between bars for credit interest, and periods of the Returns and SharpeRatio analyzers
+        dts = [bt.num2date(dtnum) for dtnum in self.datetime.tolist()]
+        ordinals = np.array([dt.toordinal() for dt in dts], dtype=np.int64)
+        days = np.diff(ordinals, prepend=ordinals[:1])
+        self.days = days.tolist()
+        self.day_bars = np.flatnonzero(days).tolist()
+        self.periods = PeriodKeys(timeframe, compression).ranks(dts)
+        self.years = PeriodKeys(bt.TimeFrame.Years, 1).ranks(dts)
+
+        self.cache = {}
+
+    @classmethod
+    def from_cerebro(cls, cerebro):
+        '''
+        Engine over the first data of `cerebro`, which is preloaded so that `validate` can run strategies with it
+        '''
+        prepare_cerebro(cerebro, runonce=True, stdstats=False)
+
+        data = cerebro.datas[0]
+        columns = {name: np.frombuffer(getattr(data.lines, name).array)[:data.buflen()].copy() for name in data.getlinealiases()}
+
+        engine = cls(columns, name=data._name, cash=cerebro.broker.startingcash, comminfo=cerebro.broker.getcommissioninfo(data),
+                     timeframe=data._timeframe, compression=data._compression)
+        engine.cerebro = cerebro
+        return engine
+
+    def indicator(self, function, line, *args):
+        # arrays of indicators are computed once per engine and shared by test cases
+        key = (function.__name__, line) + args
+        if key not in self.cache:
+            self.cache[key] = function(getattr(self, line), *args)
+
+        return self.cache[key]
+
+    def params(self, strategy, kwargs):
+        p = dict(strategy.params._getitems())
+
+        unknown = set(kwargs) - set(p)
+        if unknown:
+            raise ValueError(f'unknown parameters of {strategy.__name__}: {", ".join(sorted(unknown))}')
+
+        p.update(kwargs)
+        p.update((key, value) for key, value in p['optimization_dict'].items() if key in p)
+
+        if p.get('prune_checkpoints') or p.get('prune_drawdown'):
+            raise ValueError('early stopping of test cases is not simulated')
+
+        return SimpleNamespace(**p)
+
+    def run(self, strategy, **kwargs):
+        '''
+        Record of a test case of `strategy`, same keys and values as `strat_record` of a backtrader run
+        '''
+        if strategy not in self.RULES:
+            raise ValueError(f'{strategy.__name__} is not simulated, one of {", ".join(cls.__name__ for cls in self.RULES)}')
+
+        p = self.params(strategy, kwargs)
+        rule = self.RULES[strategy](self, p)
+
+        start, end = (int(i) for i in np.searchsorted(self.datetime, (bt.date2num(p.datetime_from), bt.date2num(p.datetime_before)), side='left'))
+        account, stop = self.simulate(rule, start, end)
+
+        record = {key: value if isinstance(value, numbers.Number) else str(value) for key, value in vars(p).items() if key not in RUN_PARAMS}
+        record.update(self.analyze(account, 0, stop))
+        return record
+
+    def simulate(self, rule, start, end):
+        '''
+        Iterate the bars at which the strategy submits orders or orders are executed, from the first bar of its next,
+        positions are closed from the first bar at or after `end` on, then the run stops at the first bar without one
+        Returns the account and the last bar run
+        '''
+        last = self.buflen - 1
+        account = Account(self, start)
+        pending = []
+
+        bar = max(start, rule.first_bar)
+        if bar > last:
+            account.advance(last)
+            return account, last
+
+        account.advance(bar)
+        while True:
+            size = account.position.size
+            if bar >= end:
+                if not size:
+                    break
+
+                submitted = [Order(-size, float(self.close[bar]))]
+            else:
+                submitted = rule.orders(bar, size)
+
+            if bar == last:
+                break
+
+            # next bar at which anything happens, market orders are executed at the next one
+            if submitted:
+                j = bar + 1
+            else:
+                j = rule.next_bar(bar, size)
+                j = min(j if j is not None else end, end, last)
+
+                for order in pending:
+                    triggered, order.price = self.trail_stop(order, bar + 1, j)
+                    if triggered is not None:
+                        j = triggered
+
+            account.advance(j - 1)
+            pending.extend(account.check(submitted))
+            account.credit(j)
+
+            for order in list(pending):
+                if order.trail is None:
+                    account.execute(order.size, self.open[j])
+                    pending.remove(order)
+                    continue
+
+                price = self.stop_price(order, j)
+                if price is not None:
+                    account.execute(order.size, price)
+                    pending.remove(order)
+                else:
+                    order.price = (min if order.isbuy() else max)(order.price, float(order.trail[j]))
+
+            account.settle(j)
+            bar = j
+
+        return account, bar
+
+    def stop_price(self, order, bar):
+        # price of a stop order executed at `bar`, the open if it gaps over the stop level, None if not executed
+        level = order.price
+        if order.isbuy():
+            if self.open[bar] >= level:
+                return float(self.open[bar])
+            if self.high[bar] >= level:
+                return level
+
+        else:
+            if self.open[bar] <= level:
+                return float(self.open[bar])
+            if self.low[bar] <= level:
+                return level
+
+        return None
+
+    def trail_stop(self, order, first, end, chunk=64):
+        '''
+        First bar from `first` and before `end` at which a trailing stop is executed and its level at that bar,
+        or None and its level at `end`, searched in chunks of growing size
+        '''
+        level = order.price
+        accumulate, tighter = (np.minimum.accumulate, min) if order.isbuy() else (np.maximum.accumulate, max)
+
+        while first < end:
+            stop = min(first + chunk, end)
+            levels = accumulate(np.concatenate(([level], order.trail[first:stop - 1])))
+
+            if order.isbuy():
+                hit = (self.open[first:stop] >= levels) | (self.high[first:stop] >= levels)
+            else:
+                hit = (self.open[first:stop] <= levels) | (self.low[first:stop] <= levels)
+
+            if hit.any():
+                i = int(np.argmax(hit))
+                return first + i, float(levels[i])
+
+            level = tighter(float(levels[-1]), float(order.trail[stop - 1]))
+            first, chunk = stop, chunk * 2
+
+        return None, level
+
+    def analyze(self, account, start, stop):
+        '''
+        DrawDown, Returns and SharpeRatio of the values of the bars `start` to `stop`, as flattened by `strat_record`
+        '''
+        bars = slice(start, stop + 1)
+        cash, size, price = account.history(start, stop)
+        close = self.close[bars]
+
+        # `BackBroker._get_value`, long positions are unlevered
+        comminfo = self.comminfo
+        dvalue = size * close
+        dunrealized = size * (close - price) * comminfo.p.mult
+        values = cash + np.where(dvalue > 0, (dvalue - dunrealized) / comminfo.get_leverage() + dunrealized, dvalue)
+
+        # DrawDown, the length is the number of bars since the last one without drawdown
+        peaks = np.maximum.accumulate(values)
+        moneydown = peaks - values
+        drawdown = 100.0 * moneydown / peaks
+
+        index = np.arange(len(values))
+        lengths = index - np.maximum.accumulate(np.where(drawdown != 0.0, -1, index))
+        max_len = int(lengths.max())
+
+        record = {
+            'drawdown_len': int(lengths[-1]),
+            'drawdown_drawdown': float(drawdown[-1]),
+            'drawdown_moneydown': float(moneydown[-1]),
+            'drawdown_max_len': max_len if max_len else 0.0,
+            'drawdown_max_drawdown': max(0.0, float(drawdown.max())),
+            'drawdown_max_moneydown': max(0.0, float(moneydown.max())),
+        }
+
+        # Returns, averaged over the periods of the timeframe of the data
+        periods = np.maximum.accumulate(self.periods[bars])
+        tcount = 1 + np.count_nonzero(periods[1:] > periods[:-1])
+
+        nlrtot = float(values[-1]) / self.cash
+        rtot = math.log(nlrtot) if nlrtot >= 0.0 else float('-inf')
+        ravg = rtot / tcount
+        rnorm = math.expm1(ravg * bt.analyzers.Returns._TANN.get(self.timeframe, 1.0)) if ravg > float('-inf') else ravg
+
+        record.update(returns_rtot=rtot, returns_ravg=ravg, returns_rnorm=rnorm, returns_rnorm100=rnorm * 100.0)
+
+        # SharpeRatio of yearly returns, from the value of the last bar of each year
+        years = np.maximum.accumulate(self.years[bars])
+        lasts = np.flatnonzero(np.append(years[1:] > years[:-1], True))
+        ends = [self.cash] + values[lasts].tolist()
+        returns = [value / previous - 1.0 for previous, value in zip(ends, ends[1:])]
+
+        rate = pow(1.0 + bt.analyzers.SharpeRatio.params.riskfreerate, 1.0 / bt.analyzers.SharpeRatio.RATEFACTORS[bt.TimeFrame.Years]) - 1.0
+        ret_free = [r - rate for r in returns]
+        ret_free_avg = average(ret_free)
+        try:
+            ratio = ret_free_avg / standarddev(ret_free, avgx=ret_free_avg, bessel=False)
+        except ZeroDivisionError:
+            ratio = None
+
+        record['sharperatio_sharperatio'] = ratio if ratio is not None else str(ratio)
+        return record
+
+    def validate(self, strategy, **kwargs):
+        '''
+        Run a test case with backtrader too, returns the keys whose values differ as (key, vectorized, backtrader)
+        '''
+        if self.cerebro is None:
+            raise ValueError('validation needs an engine made by from_cerebro')
+
+        record = self.run(strategy, **kwargs)
+
+        self.cerebro._event_stop = False
+        strat, = self.cerebro.runstrategies([(strategy, (), kwargs)], predata=True)
+
+        return [(key, record.get(key), value) for key, value in strat_record(strat).items() if not same_value(record.get(key), value)]